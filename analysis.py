@@ -0,0 +1,367 @@
+"""
+Static analysis helpers for compiler
+
+These functions work directly on the token list produced by the lexer,
+the same representation the interpreter walks, so positions returned
+here can be used as values of interpreter.next
+"""
+
+# Tokens that open a construct closed by a matching 'end'
+BLOCK_OPENERS = ("IF", "WHILE", "FOR", "FUNCTION")
+
+# Binary operators that may continue an expression
+OPERATORS = ("PLUS", "MINUS", "MULTIPLY", "DIVIDE")
+
+
+def find_end(tokens, pos):
+    """
+    Return the position of the 'end' that closes the block starting at pos
+
+    Works the same way as interpreter.skip_to_end, but does not move
+    the interpreter's position
+    """
+    depth = 0
+
+    while pos < len(tokens):
+        if tokens[pos].type == "END":
+            if depth == 0:
+                return pos
+            else:
+                depth -= 1
+
+        elif tokens[pos].type in BLOCK_OPENERS:
+            depth += 1
+
+        pos += 1
+
+    return pos
+
+
+def find_close(tokens, pos):
+    """
+    Return the position just past the ')' or ']' matching the '(' or
+    '[' at pos
+    """
+    opener = tokens[pos].type
+    closer = "RPAREN" if opener == "LPAREN" else "RBRACKET"
+    depth = 0
+
+    while pos < len(tokens):
+        if tokens[pos].type == opener:
+            depth += 1
+        elif tokens[pos].type == closer:
+            depth -= 1
+            if depth == 0:
+                return pos + 1
+        pos += 1
+
+    return pos
+
+
+def expression_end(tokens, pos):
+    """
+    Return the position just past the expression starting at pos
+
+    Expression --> Term [('+' | '-') Expression]
+    """
+    expect_operand = True
+
+    while pos < len(tokens):
+        kind = tokens[pos].type
+
+        if expect_operand:
+            if kind == "MINUS":
+                pos += 1
+            elif kind == "LPAREN":
+                pos = find_close(tokens, pos)
+                expect_operand = False
+            elif kind in ("NAME", "NUMBER"):
+                pos += 1
+                if kind == "NAME" and pos < len(tokens) and tokens[pos].type in ("LBRACKET", "LPAREN"):
+                    pos = find_close(tokens, pos)
+                expect_operand = False
+            elif kind in ("LENGTH", "SUM"):
+                pos = find_close(tokens, pos + 1)
+                expect_operand = False
+            else:
+                break
+
+        elif kind in OPERATORS:
+            pos += 1
+            expect_operand = True
+
+        else:
+            break
+
+    return pos
+
+
+def condition_end(tokens, pos):
+    """
+    Return the position just past the condition starting at pos
+
+    Condition --> Expression RelOp Expression
+    """
+    pos = expression_end(tokens, pos)
+    return expression_end(tokens, pos + 1)
+
+
+def statement_end(tokens, pos):
+    """
+    Return the position just past the statement starting at pos
+    """
+    kind = tokens[pos].type
+
+    if kind == "INPUT":
+        return pos + 2
+    elif kind == "NAME" and tokens[pos + 1].type == "LPAREN":
+        return find_close(tokens, pos + 1)
+    elif kind == "NAME":
+        if tokens[pos + 1].type == "LBRACKET":
+            pos = find_close(tokens, pos + 1) - 1
+        return expression_end(tokens, pos + 2)
+    elif kind == "ARRAY":
+        return find_close(tokens, pos + 2)
+    elif kind == "FILL":
+        return expression_end(tokens, pos + 3)
+    elif kind in ("PRINT", "QUIT", "RETURN"):
+        return expression_end(tokens, pos + 1)
+    elif kind in BLOCK_OPENERS:
+        return find_end(tokens, pos + 1) + 1
+    else:
+        return pos + 1
+
+
+def statements(tokens, start, stop):
+    """
+    Return the positions of the top-level statements between start and stop
+    """
+    positions = []
+
+    while start < stop and tokens[start].type != "END":
+        positions.append(start)
+        start = statement_end(tokens, start)
+
+    return positions
+
+
+def else_position(tokens, start, stop):
+    """
+    Return the position of the 'else' belonging to the if statement
+    whose block starts at start, or stop if there is none
+    """
+    pos = start
+    while pos < stop:
+        if tokens[pos].type == "ELSE":
+            return pos
+        pos = statement_end(tokens, pos)
+    return stop
+
+
+def assigned_before_read(tokens, start, stop, written, defined):
+    """
+    Check that every variable written between start and stop is
+    assigned before it is read
+
+    defined holds the variables already assigned when start is
+    reached, and is updated as statements are checked. A variable
+    assigned inside a while or for body, or in only one branch of an
+    if, is only defined within that construct.
+    """
+
+    def reads_ok(first, last):
+        for name in names(tokens, first, last):
+            if name in written and name not in defined:
+                return False
+        return True
+
+    for pos in statements(tokens, start, stop):
+        kind = tokens[pos].type
+        end = statement_end(tokens, pos)
+
+        if kind == "NAME" and tokens[pos + 1].type == "LPAREN":
+            if not reads_ok(pos + 1, end):
+                return False
+
+        elif kind == "NAME":
+            if tokens[pos + 1].type == "LBRACKET":
+                return False
+            if not reads_ok(pos + 2, end):
+                return False
+            defined.add(tokens[pos].value)
+
+        elif kind in ("PRINT", "RETURN"):
+            if not reads_ok(pos + 1, end):
+                return False
+
+        elif kind == "IF":
+            cond_end = condition_end(tokens, pos + 1)
+            if not reads_ok(pos + 1, cond_end):
+                return False
+
+            # Check each branch separately, only variables assigned in
+            # both branches are defined once the if statement is done
+            else_pos = else_position(tokens, cond_end + 1, end - 1)
+            then_defined = set(defined)
+            if not assigned_before_read(tokens, cond_end + 1, else_pos, written, then_defined):
+                return False
+            if else_pos < end - 1:
+                else_defined = set(defined)
+                if not assigned_before_read(tokens, else_pos + 2, end - 1, written, else_defined):
+                    return False
+                defined |= then_defined & else_defined
+
+        elif kind == "WHILE":
+            cond_end = condition_end(tokens, pos + 1)
+            if not reads_ok(pos + 1, cond_end):
+                return False
+            if not assigned_before_read(tokens, cond_end + 1, end - 1, written, set(defined)):
+                return False
+
+        elif kind == "FOR":
+            # 'for' '(' Name ':=' Expression 'to' Expression ')'
+            header_end = find_close(tokens, pos + 1)
+            if not reads_ok(pos + 4, header_end):
+                return False
+            defined.add(tokens[pos + 2].value)
+            if not assigned_before_read(tokens, header_end, end - 1, written, set(defined)):
+                return False
+
+        else:
+            return False
+
+    return True
+
+
+def pure(tokens, start, stop, params, name, pure_functions):
+    """
+    Return True if the body of the function called name, between start
+    and stop, is pure
+
+    A pure function does no input or output, does not use arrays, reads
+    only its parameters and the local variables it has assigned, and
+    only calls itself or functions in pure_functions. Its result then
+    depends only on its arguments.
+    """
+    for pos in range(start, stop):
+        kind = tokens[pos].type
+
+        if kind in ("PRINT", "INPUT", "QUIT", "ARRAY", "FILL", "LBRACKET", "LENGTH", "SUM", "FUNCTION"):
+            return False
+
+        if kind == "NAME" and tokens[pos + 1].type == "LPAREN":
+            callee = tokens[pos].value
+            if callee != name and callee not in pure_functions:
+                return False
+
+    # Any variable that is not local would be read from the global frame
+    local = assigned_names(tokens, start, stop) | set(params)
+    for pos in range(start, stop):
+        if tokens[pos].type == "NAME" and tokens[pos + 1].type != "LPAREN":
+            if tokens[pos].value not in local:
+                return False
+
+    return assigned_before_read(tokens, start, stop, local, set(params))
+
+
+def names(tokens, start, stop):
+    """
+    Return the set of variable names referenced between start and stop
+    """
+    return {t.value for t in tokens[start:stop] if t.type == "NAME"}
+
+
+def assigned_names(tokens, start, stop):
+    """
+    Return the set of variable names assigned between start and stop
+
+    This includes the index variables of for loops, and arrays that
+    are declared, filled or have an element assigned
+    """
+    assigned = set()
+
+    for pos in range(start, stop - 1):
+        if tokens[pos].type == "NAME" and tokens[pos + 1].type == "ASSIGN":
+            assigned.add(tokens[pos].value)
+        elif tokens[pos].type in ("INPUT", "ARRAY", "FILL") and tokens[pos + 1].type == "NAME":
+            assigned.add(tokens[pos + 1].value)
+        elif tokens[pos].type == "RBRACKET" and tokens[pos + 1].type == "ASSIGN":
+            # Walk back to the name of the array being assigned
+            depth = 0
+            for back in range(pos, start - 1, -1):
+                if tokens[back].type == "RBRACKET":
+                    depth += 1
+                elif tokens[back].type == "LBRACKET":
+                    depth -= 1
+                    if depth == 0:
+                        assigned.add(tokens[back - 1].value)
+                        break
+
+    return assigned
+
+
+def constant(tokens, start, stop):
+    """
+    Return the value of the expression between start and stop if it
+    only involves numbers, otherwise None
+
+    The expression is evaluated with the same grammar as the
+    interpreter uses, so the result matches what it would compute
+    """
+    for t in tokens[start:stop]:
+        if t.type not in OPERATORS + ("NUMBER", "LPAREN", "RPAREN"):
+            return None
+
+    try:
+        value, pos = constant_expression(tokens, start)
+    except (ZeroDivisionError, IndexError):
+        return None
+
+    if pos != stop:
+        return None
+    return value
+
+
+def constant_expression(tokens, pos):
+    """
+    Expression --> Term [('+' | '-') Expression]
+    """
+    value, pos = constant_term(tokens, pos)
+    if tokens[pos].type == "PLUS":
+        rest, pos = constant_expression(tokens, pos + 1)
+        return value + rest, pos
+    elif tokens[pos].type == "MINUS":
+        rest, pos = constant_expression(tokens, pos + 1)
+        return value - rest, pos
+    return value, pos
+
+
+def constant_term(tokens, pos):
+    """
+    Term --> Factor [( '*' | '/' ) Factor]
+    """
+    value, pos = constant_factor(tokens, pos)
+    if tokens[pos].type == "MULTIPLY":
+        other, pos = constant_factor(tokens, pos + 1)
+        return value * other, pos
+    elif tokens[pos].type == "DIVIDE":
+        other, pos = constant_factor(tokens, pos + 1)
+        return value / other, pos
+    return value, pos
+
+
+def constant_factor(tokens, pos):
+    """
+    Factor --> '-' Factor | Number | '(' Expression ')'
+    """
+    if tokens[pos].type == "MINUS":
+        value, pos = constant_factor(tokens, pos + 1)
+        return -1 * value, pos
+    elif tokens[pos].type == "NUMBER":
+        return tokens[pos].value, pos + 1
+    elif tokens[pos].type == "LPAREN":
+        value, pos = constant_expression(tokens, pos + 1)
+        if tokens[pos].type != "RPAREN":
+            raise IndexError(pos)
+        return value, pos + 1
+    raise IndexError(pos)
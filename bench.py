@@ -0,0 +1,218 @@
+"""
+Hot loop benchmarks for compiler
+
+Times a few loop-heavy programs in the interpreter with the fused fast
+paths (see fusion.py) turned off and on, and prints the best time of
+each and the speedup.
+
+Given the directory of another checkout, such as a release or the
+commit before a change, the programs are also timed without fused
+paths in that interpreter, so changes to the generic path can be
+compared against it.
+
+Usage: bench.py [repeat] [baseline directory]
+"""
+
+import contextlib, io, subprocess, sys, time
+import interpreter
+
+# Each benchmark is a name and a program
+BENCHMARKS = [
+    (
+        "count",
+        """
+program count:
+  i := 0
+  while i < 200000:
+    i := i + 1
+  end
+  print i
+end
+""",
+    ),
+    (
+        "sum",
+        """
+program total:
+  s := 0
+  i := 0
+  while i < 100000:
+    s := s + i
+    i := i + 1
+  end
+  print s
+end
+""",
+    ),
+    (
+        "fib",
+        """
+program fib:
+  a := 0
+  b := 1
+  n := 0
+  while n < 60000:
+    t := a
+    a := b
+    b := b + t
+    a := a - 0
+    n := n + 1
+  end
+  print n
+end
+""",
+    ),
+    (
+        "nested",
+        """
+program nested:
+  s := 0
+  for (i := 1 to 200)
+    for (j := 1 to 200)
+      s := s + i * j
+    end
+  end
+  print s
+end
+""",
+    ),
+    (
+        "branch",
+        """
+program branch:
+  evens := 0
+  odds := 0
+  parity := 0
+  i := 0
+  limit := 100000
+  while i < limit:
+    if parity = 0:
+      evens := evens + 1
+    else:
+      odds := odds + 1
+    end
+    parity := 1 - parity
+    if evens > odds:
+      odds := odds + 0
+    end
+    i := i + 1
+  end
+  print evens
+end
+""",
+    ),
+    (
+        # Nothing here has a fused shape, so this times the generic path
+        "unfused",
+        """
+program unfused:
+  a := 3
+  b := 4
+  i := 0
+  while i < 60000 + 0:
+    x := a * b
+    y := (x - a) * 2
+    i := 1 + i
+  end
+  print y
+end
+""",
+    ),
+]
+
+# Times a program in the interpreter of another checkout, given its
+# directory and the repeat count, without fused paths if it has them.
+# Older interpreters do not reset their position between runs.
+BASELINE = """
+import contextlib, io, sys, time
+sys.path.insert(0, sys.argv[1])
+import interpreter
+
+source = sys.stdin.read()
+options = {"fuse": False} if "fuse" in interpreter.interpret.__code__.co_varnames else {}
+interpreter.parallel_loops = False
+
+best = None
+for i in range(int(sys.argv[2])):
+    interpreter.next = 0
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        interpreter.interpret(source, **options)
+    elapsed = time.perf_counter() - start
+    if best is None or elapsed < best:
+        best = elapsed
+
+print(best)
+"""
+
+
+def best_time(source, fuse, repeat):
+    """
+    Return the best time of repeat runs of source
+    """
+    best = None
+
+    for i in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            interpreter.interpret(source, fuse=fuse)
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def baseline_time(source, directory, repeat):
+    """
+    Return the best time of repeat runs of source in the interpreter
+    in directory
+    """
+    result = subprocess.run(
+        [sys.executable, "-c", BASELINE, directory, str(repeat)],
+        input=source,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(result.stdout)
+
+
+def bench(repeat=3, baseline=None):
+    """
+    Run every benchmark, return a list of (name, generic time, fused
+    time, baseline time)
+
+    The baseline time is None unless the directory of a baseline
+    checkout is given
+    """
+    # Parallel for loops would hide the cost of the interpreter itself
+    interpreter.parallel_loops = False
+
+    results = []
+    for name, source in BENCHMARKS:
+        base = None
+        if baseline is not None:
+            base = baseline_time(source, baseline, repeat)
+        results.append((name, best_time(source, False, repeat), best_time(source, True, repeat), base))
+
+    interpreter.parallel_loops = True
+    return results
+
+
+### Main
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    baseline = sys.argv[2] if len(sys.argv) > 2 else None
+
+    header = "%-10s %10s %10s %8s" % ("benchmark", "generic", "fused", "speedup")
+    if baseline is not None:
+        header += " %10s %8s" % ("baseline", "generic")
+    print(header)
+
+    for name, generic, fused, base in bench(repeat, baseline):
+        line = "%-10s %9.3fs %9.3fs %7.2fx" % (name, generic, fused, generic / fused)
+        if base is not None:
+            line += " %9.3fs %7.2fx" % (base, base / generic)
+        print(line)
@@ -0,0 +1,213 @@
+"""
+Static cost model for compiler
+
+Estimates how much work a program will do before it is run, so that
+programs over a budget can be rejected up front. Calls are charged the
+estimated cost of the called function's body, which is worked out once
+per function. One operation is one executed statement or one loop
+iteration, the same unit counted by the interpreter when it enforces a
+runtime operation limit.
+"""
+
+import analysis, lexer, math, sys
+
+# Iterations assumed for while loops and for loops whose bounds are
+# not constant
+DEFAULT_TRIPS = 100
+
+
+class Estimate:
+    """
+    Class that holds the result of the cost analysis
+
+    self.operations is the estimated number of operations
+    self.depth is the deepest loop nesting found
+    self.unbounded lists the token positions of loops whose iteration
+    count could not be determined, and of recursive functions
+    """
+
+    def __init__(self, operations=0, depth=0, unbounded=None):
+        self.operations = operations
+        self.depth = depth
+        self.unbounded = unbounded if unbounded is not None else []
+
+    def __str__(self):
+        """
+        Return a string representation of this object's data
+        """
+        return "%d operations, loop depth %d, %d unbounded loops" % (
+            self.operations,
+            self.depth,
+            len(self.unbounded),
+        )
+
+
+def trips(tokens, pos):
+    """
+    Return the iteration count of the for loop at pos, or None if its
+    bounds are not constant
+
+    'for' '(' Name ':=' Expression 'to' Expression ')'
+    """
+    first_end = analysis.expression_end(tokens, pos + 4)
+    last_end = analysis.expression_end(tokens, first_end + 1)
+
+    first = analysis.constant(tokens, pos + 4, first_end)
+    last = analysis.constant(tokens, first_end + 1, last_end)
+    if first is None or last is None:
+        return None
+
+    if first > last:
+        return 0
+    return math.floor(last - first) + 1
+
+
+def definitions(tokens):
+    """
+    Find every function definition in the program
+
+    Return a dictionary mapping each function name to the position of
+    its definition and the start and end of its body
+    """
+    functions = {}
+
+    for pos in range(len(tokens)):
+        if tokens[pos].type == "FUNCTION":
+            body_start = analysis.find_close(tokens, pos + 2) + 1
+            body_end = analysis.find_end(tokens, body_start)
+            functions[tokens[pos + 1].value] = (pos, body_start, body_end)
+
+    return functions
+
+
+def calls_cost(tokens, start, stop, depth, result, functions, costs, active):
+    """
+    Return the estimated operations for the function calls between
+    start and stop
+
+    costs maps each function estimated so far to the operations of a
+    call and the loop depth of its body. active holds the functions
+    whose bodies are being estimated. A call to one of them is
+    recursive: its body is assumed to run DEFAULT_TRIPS times and it is
+    reported as unbounded.
+    """
+    total = 0
+
+    for pos in range(start, stop):
+        if tokens[pos].type != "NAME" or tokens[pos + 1].type != "LPAREN":
+            continue
+
+        name = tokens[pos].value
+        if name not in functions:
+            continue
+
+        definition, body_start, body_end = functions[name]
+        if name in active:
+            if definition not in result.unbounded:
+                result.unbounded.append(definition)
+            continue
+
+        if name not in costs:
+            # The body's own loop depth is added to the depth of every
+            # call site
+            outer = result.depth
+            result.depth = 0
+
+            active.add(name)
+            body = block_cost(tokens, body_start, body_end, 0, result, functions, costs, active)
+            active.remove(name)
+
+            if definition in result.unbounded:
+                body *= DEFAULT_TRIPS
+            costs[name] = (body, result.depth)
+            result.depth = outer
+
+        body, body_depth = costs[name]
+        result.depth = max(result.depth, depth + body_depth)
+        total += body
+
+    return total
+
+
+def block_cost(tokens, start, stop, depth, result, functions, costs, active):
+    """
+    Return the estimated operations for the statements between start
+    and stop, recording loop depth and unbounded loops in result
+    """
+    total = 0
+
+    for pos in analysis.statements(tokens, start, stop):
+        kind = tokens[pos].type
+        end = analysis.statement_end(tokens, pos)
+
+        # Every statement counts as one operation
+        total += 1
+
+        if kind == "IF":
+            cond_end = analysis.condition_end(tokens, pos + 1)
+            total += calls_cost(tokens, pos + 1, cond_end, depth, result, functions, costs, active)
+
+            else_pos = analysis.else_position(tokens, cond_end + 1, end - 1)
+            then_cost = block_cost(tokens, cond_end + 1, else_pos, depth, result, functions, costs, active)
+            else_cost = 0
+            if else_pos < end - 1:
+                else_cost = block_cost(tokens, else_pos + 2, end - 1, depth, result, functions, costs, active)
+            total += max(then_cost, else_cost)
+
+        elif kind in ("WHILE", "FOR"):
+            result.depth = max(result.depth, depth + 1)
+
+            if kind == "WHILE":
+                body_start = analysis.condition_end(tokens, pos + 1) + 1
+                count = None
+            else:
+                body_start = analysis.find_close(tokens, pos + 1)
+                count = trips(tokens, pos)
+
+            if count is None:
+                result.unbounded.append(pos)
+                count = DEFAULT_TRIPS
+
+            # The while condition is evaluated on every iteration, the
+            # for bounds only once
+            header = calls_cost(tokens, pos + 1, body_start, depth, result, functions, costs, active)
+            body = block_cost(tokens, body_start, end - 1, depth + 1, result, functions, costs, active)
+            if kind == "WHILE":
+                total += count * (body + header + 1)
+            else:
+                total += header + count * (body + 1)
+
+        elif kind != "FUNCTION":
+            # A function definition only costs anything when it is called
+            total += calls_cost(tokens, pos, end, depth, result, functions, costs, active)
+
+    return total
+
+
+def estimate(tokens):
+    """
+    Estimate the work done by a whole program
+
+    Program --> 'program' Name ':' Block 'end'
+    """
+    result = Estimate()
+    functions = definitions(tokens)
+    result.operations = block_cost(tokens, 3, len(tokens) - 1, 0, result, functions, {}, set())
+    return result
+
+
+### Main
+if __name__ == "__main__":
+    # The name of the program file is the first command line argument
+    filename = sys.argv[1]
+
+    source = open(filename).read()
+    tokens = lexer.analyze(source)
+
+    result = estimate(tokens)
+    print(result)
+    for pos in result.unbounded:
+        if tokens[pos].type == "FUNCTION":
+            print("Recursive function %s at token %d" % (tokens[pos + 1].value, pos))
+        else:
+            print("Unbounded %s loop at token %d" % (tokens[pos].value, pos))
@@ -0,0 +1,255 @@
+"""
+Fused fast paths for compiler
+
+A pre-pass over the tokens that finds the statement and condition
+shapes programs run most often and builds a specialized handler for
+each one, so the interpreter can run them without going through
+assign_statement, expression, term, factor and atom:
+
+    x := 5                  constant
+    x := y                  copy
+    x := x + 1, x := x - 1  increment, for any number
+    x := x + y, x := x - y  accumulate, for any name
+    x := x + e, x := x - e  accumulate, for any other expression e,
+                            which is evaluated by the interpreter
+    a < b                   compare, for any relational operator and
+                            names or numbers on either side, when the
+                            condition is followed by ':'
+
+Handlers take the current frame and the main program's frame, read
+names from the first if they are defined there and otherwise from the
+second, and assign into the first, the same as the interpreter.
+Everything else runs through the interpreter as before.
+"""
+
+import analysis, lexer, operator, sys
+
+RELOPS = {
+    "EQUALS": operator.eq,
+    "NOT_EQUAL": operator.ne,
+    "GREATER_THAN": operator.gt,
+    "LESS_THAN": operator.lt,
+    "GREATER_THAN_OR_EQUAL": operator.ge,
+    "LESS_THAN_OR_EQUAL": operator.le,
+}
+
+
+def fuse(tokens):
+    """
+    Find the fused shapes in a program
+
+    Return two dictionaries, for statements and for conditions, that
+    map the position of the first token of each fused shape to its
+    handler. Statement handlers return the position just past the
+    statement. Conditions map to their handler and the position just
+    past them, and their handlers return the value of the condition.
+    Each handler is named after its shape.
+    """
+    statements = {}
+    conditions = {}
+
+    for pos in range(len(tokens) - 3):
+        t = tokens[pos]
+        # The assignments in 'fill' statements and for loop headers are
+        # not statements of their own
+        if (
+            t.type == "NAME"
+            and tokens[pos + 1].type == "ASSIGN"
+            and (pos == 0 or tokens[pos - 1].type not in ("FILL", "LPAREN"))
+        ):
+            fused = assignment(tokens, pos)
+            if fused is not None:
+                statements[pos] = fused
+
+        elif t.type in ("IF", "WHILE"):
+            fused = comparison(tokens, pos + 1)
+            if fused is not None:
+                conditions[pos + 1] = fused
+
+    return statements, conditions
+
+
+def assignment(tokens, pos):
+    """
+    Return the handler for the assignment at pos, or None if it has no
+    fused shape
+
+    Name ':=' Expression
+    """
+    target = tokens[pos].value
+    first = pos + 2
+    end = analysis.expression_end(tokens, first)
+    length = end - first
+
+    if length == 1 and tokens[first].type == "NUMBER":
+        return constant(target, tokens[first].value, end)
+
+    if length == 1 and tokens[first].type == "NAME":
+        return copy(target, tokens[first].value, end)
+
+    # The right hand side must start with the target on its own,
+    # followed by '+' or '-' and the rest of the expression, which the
+    # grammar makes the whole right operand
+    if (
+        length < 3
+        or tokens[first].type != "NAME"
+        or tokens[first].value != target
+        or tokens[first + 1].type not in ("PLUS", "MINUS")
+    ):
+        return None
+
+    subtract = tokens[first + 1].type == "MINUS"
+    operand = tokens[first + 2]
+
+    if length == 3 and operand.type == "NUMBER":
+        step = -operand.value if subtract else operand.value
+        return increment(target, step, end)
+
+    if length == 3 and operand.type == "NAME":
+        return accumulate_name(target, operand.value, subtract, end)
+
+    # The rest is left to the interpreter, which knows where it ends:
+    # expression_end takes any chain of '*' and '/', where a term only
+    # allows one
+    return accumulate(target, first + 2, subtract)
+
+
+def comparison(tokens, pos):
+    """
+    Return the handler for the condition at pos and the position just
+    past it, or None if it has no fused shape
+
+    (Name | Number) RelOp (Name | Number) ':'
+    """
+    lhs, relop, rhs = tokens[pos : pos + 3]
+
+    if (
+        relop.type not in RELOPS
+        or lhs.type not in ("NAME", "NUMBER")
+        or rhs.type not in ("NAME", "NUMBER")
+        or (lhs.type == "NUMBER" and rhs.type == "NUMBER")
+        or pos + 3 >= len(tokens)
+        or tokens[pos + 3].type != "COLON"
+    ):
+        return None
+
+    return compare(RELOPS[relop.type], lhs, rhs), pos + 3
+
+
+def constant(target, value, end):
+    """
+    Return a handler assigning a number to target
+    """
+
+    def constant(f, g):
+        f[target] = value
+        return end
+
+    return constant
+
+
+def copy(target, source, end):
+    """
+    Return a handler assigning the value of source to target
+    """
+
+    def copy(f, g):
+        f[target] = f[source] if source in f else g[source]
+        return end
+
+    return copy
+
+
+def increment(target, step, end):
+    """
+    Return a handler adding step to target
+    """
+
+    def increment(f, g):
+        f[target] = (f[target] if target in f else g[target]) + step
+        return end
+
+    return increment
+
+
+def accumulate_name(target, source, subtract, end):
+    """
+    Return a handler adding or subtracting the value of source to target
+    """
+    if subtract:
+
+        def accumulate(f, g):
+            f[target] = (f[target] if target in f else g[target]) - (
+                f[source] if source in f else g[source]
+            )
+            return end
+
+    else:
+
+        def accumulate(f, g):
+            f[target] = (f[target] if target in f else g[target]) + (
+                f[source] if source in f else g[source]
+            )
+            return end
+
+    return accumulate
+
+
+def accumulate(target, start, subtract):
+    """
+    Return a handler adding or subtracting the expression at start,
+    evaluated by the interpreter, to target
+
+    The handler returns the position the interpreter stopped at, so a
+    malformed expression fails the same way as without fusion.
+    """
+    import interpreter
+
+    def accumulate(f, g):
+        value = f[target] if target in f else g[target]
+        interpreter.next = start
+        if subtract:
+            f[target] = value - interpreter.expression()
+        else:
+            f[target] = value + interpreter.expression()
+        return interpreter.next
+
+    return accumulate
+
+
+def compare(op, lhs, rhs):
+    """
+    Return a handler comparing two names, or a name and a number
+    """
+    a = lhs.value
+    b = rhs.value
+
+    if lhs.type == "NAME" and rhs.type == "NAME":
+
+        def compare(f, g):
+            return op(f[a] if a in f else g[a], f[b] if b in f else g[b])
+
+    elif lhs.type == "NAME":
+
+        def compare(f, g):
+            return op(f[a] if a in f else g[a], b)
+
+    else:
+
+        def compare(f, g):
+            return op(a, f[b] if b in f else g[b])
+
+    return compare
+
+
+### Main
+if __name__ == "__main__":
+    # The name of the program file is the first command line argument
+    filename = sys.argv[1]
+
+    source = open(filename).read()
+    statements, conditions = fuse(lexer.analyze(source))
+
+    conditions = {pos: handler for pos, (handler, end) in conditions.items()}
+    for pos, handler in sorted({**statements, **conditions}.items()):
+        print("token %d: %s" % (pos, handler.__name__))
@@ -2,13 +2,99 @@
 Interpreter for compiler
 """
 
-import lexer
+import analysis, array, collections, cost, fusion, jit, lexer, metrics, optimizer, parallel, sys, time
 
 # Module-level variables to keep track of the state of the interpreter
 next = 0
 symbols = {}
 tokens = []
 
+# Variables of the main program. Inside a function call, symbols is
+# the call's own frame and names not found there are looked up here.
+global_symbols = symbols
+
+# Functions defined so far, and how many calls are in progress
+functions = {}
+call_depth = 0
+
+# Cache the results of pure functions, keeping at most MEMO_SIZE
+# results for each function
+memoize = True
+MEMO_SIZE = 256
+
+# Python stack frames allowed while a program runs. Each call of a
+# function takes about ten, so this allows recursion a few thousand
+# calls deep.
+RECURSION_LIMIT = 30000
+
+# Run independent for loop iterations across a process pool
+parallel_loops = True
+
+# Compile hot loops into closures (see jit.py)
+jit_loops = False
+
+# Run common statement and condition shapes through fused handlers
+# (see fusion.py). The handlers for the program being run are keyed by
+# the position of the first token of their statement or condition.
+fast_paths = True
+fused_statements = {}
+fused_conditions = {}
+
+# Descriptions of the loops changed by the loop optimizer
+optimizations = []
+
+# Records or replays inputs, branch outcomes and output (see tracing.py)
+tracer = None
+
+# Statements and loop iterations executed so far, and the most allowed
+# before the program is stopped (None for no limit)
+operations = 0
+max_operations = None
+
+# Update the runtime counters (see metrics.py), checked once per run.
+# The counts are kept by token position: statements starting at each
+# position, iterations of the loop at each position, and blocks skipped
+# from each position and the tokens walked to skip them.
+collecting = False
+statement_hits = []
+iteration_hits = []
+skip_hits = []
+skip_tokens = []
+
+# Whether statements and loop iterations are counted at all, for the
+# operation limit or the metrics. Set once per run, so runs that count
+# nothing test this one flag per statement.
+counting = False
+
+
+class Function:
+    """
+    Class that represents a user-defined function
+
+    self.params lists the parameter names and self.start is the
+    position of the first token of the body
+
+    self.pure is True if the function's results depend only on its
+    arguments, in which case self.cache holds recent results keyed by
+    the argument values. self.callees names the functions it calls.
+    """
+
+    def __init__(self, params, start, pure, callees):
+        self.params = params
+        self.start = start
+        self.pure = pure
+        self.callees = callees
+        self.cache = collections.OrderedDict()
+
+
+class ReturnValue(Exception):
+    """
+    Raised by a return statement to leave the function being called
+    """
+
+    def __init__(self, value):
+        self.value = value
+
 
 def match(expected):
     """
@@ -86,12 +172,15 @@ def check(test):
 
 def atom():
     """
-    Atom --> Name | Number | '(' Expression ')'
+    Atom --> Name ['[' Expression ']']
+     | Number
+     | '(' Expression ')'
+     | ('length' | 'sum') '(' Name ')'
 
     Atom returns a single value used in an expression
 
     For variables, it looks up the variable's associated value
-    in the symbol table
+    in the symbol table, or one element of it for an indexed array
 
     For numbers, it returns the number value saved in the token
 
@@ -99,24 +188,131 @@ def atom():
     returns the result
     """
 
-    # Return the value of a variable
-    if check("NAME"):
-        var = symbols[tokens[next].value]
-        match("NAME")
+    global next
+    kind = tokens[next].type
+
+    # Return the value of a variable, or the result of a function call
+    if kind == "NAME":
+        if tokens[next + 1].type == "LPAREN":
+            return call()
+
+        # Inlined lookup and match, since reading variables is the most
+        # common case
+        name = tokens[next].value
+        var = symbols[name] if name in symbols else global_symbols[name]
+        next += 1
+        if tokens[next].type == "LBRACKET":
+            values = array_named(name)
+            return values[array_index(values, name)]
         return var
 
     ### Add more cases to handle Number and ( Expression )
-    elif check("NUMBER"):
+    elif kind == "NUMBER":
         num = tokens[next].value
         match("NUMBER")
         return num
 
-    elif check("LPAREN"):
+    elif kind == "LPAREN":
         match("LPAREN")
         val = expression()
         match("RPAREN")
         return val
 
+    # Bulk operations over a whole array
+    elif kind == "LENGTH" or kind == "SUM":
+        match(kind)
+        match("LPAREN")
+        values = array_named(tokens[next].value)
+        match("NAME")
+        match("RPAREN")
+        if kind == "LENGTH":
+            return len(values)
+        return sum(values)
+
+
+def lookup(name):
+    """
+    Return the value of a variable, from the current call's frame if
+    it is defined there and otherwise from the main program's
+    """
+    if name in symbols:
+        return symbols[name]
+    return global_symbols[name]
+
+
+def array_named(name):
+    """
+    Look up the array called name in the symbol table
+    """
+    values = lookup(name)
+    if type(values) is not array.array:
+        print(name, "is not an array")
+        quit()
+    return values
+
+
+def array_index(values, name):
+    """
+    Index --> '[' Expression ']'
+
+    Evaluate an index into values and check that it is in range
+    """
+    match("LBRACKET")
+    i = expression()
+    match("RBRACKET")
+
+    if type(i) is not int or not 0 <= i < len(values):
+        print("Index", i, "out of range for array", name)
+        quit()
+    return i
+
+
+def array_element(value):
+    """
+    Check that value can be stored in an array
+
+    Arrays hold 64-bit integers
+    """
+    if type(value) is not int or not -(2**63) <= value < 2**63:
+        print("Array elements must be 64-bit integers, got", value)
+        quit()
+    return value
+
+
+def array_statement():
+    """
+    ArrayStatement --> 'array' Name '[' Expression ']'
+
+    Arrays are stored in contiguous typed storage and start out
+    filled with zeros
+    """
+    match("ARRAY")
+    name = tokens[next].value
+    match("NAME")
+
+    match("LBRACKET")
+    size = expression()
+    match("RBRACKET")
+
+    if type(size) is not int or size < 0:
+        print("Invalid size", size, "for array", name)
+        quit()
+    symbols[name] = array.array("q", bytes(8 * size))
+
+
+def fill_statement():
+    """
+    FillStatement --> 'fill' Name ':=' Expression
+
+    Set every element of an array to the same value
+    """
+    match("FILL")
+    values = array_named(tokens[next].value)
+    match("NAME")
+    match("ASSIGN")
+    value = array_element(expression())
+    values[:] = array.array("q", [value]) * len(values)
+
 
 def input_statement():
     """
@@ -131,17 +327,28 @@ def input_statement():
     match("NAME")
 
     # Read an input int and store it to that name
-    print("Enter a value for", name)
-    value = int(input())
+    if tracer is None:
+        print("Enter a value for", name)
+        value = int(input())
+    else:
+        value = tracer.input(name)
     symbols[name] = value
 
+    if collecting:
+        metrics.inputs.add()
+
 
 def print_statement():
     """
     print -> print expression
     """
     match("PRINT")
-    print(expression())
+    value = expression()
+    if tracer is not None:
+        tracer.output(value)
+    if collecting:
+        count_print(value)
+    print(value)
 
 
 def relOp():
@@ -201,15 +408,34 @@ def condition():
     """
     Condition --> Expression relOp Expression
     """
+    global next
+
+    fused = fused_conditions.get(next)
+    if fused is not None:
+        next = fused[1]
+        return fused[0](symbols, global_symbols)
+
     lhs = expression()
     op = relOp()
     rhs = expression()
     return evaluate_condition(lhs, op, rhs)
 
 
-def skip_to_end():
+def opens_block():
+    """
+    Check if the next token starts a construct closed by 'end'
+    """
+    return tokens[next].type in analysis.BLOCK_OPENERS
+
+
+def skip_to_end(opener):
+    """
+    Skip to the 'end' closing the block at next, which belongs to the
+    statement at opener
+    """
     global next
     depth = 0
+    start = next
 
     while next < len(tokens):
         if check("END"):
@@ -218,11 +444,106 @@ def skip_to_end():
             else:
                 depth -= 1
 
-        elif check("IF") or check("WHILE") or check("FOR"):
+        elif opens_block():
             depth += 1
 
         next += 1
 
+    if collecting:
+        count_skip(opener, start)
+
+
+def count_operation():
+    """
+    Count one executed statement or loop iteration
+
+    Stop the program once it has done more than max_operations
+    """
+    global operations
+    operations += 1
+
+    if operations > max_operations:
+        print("Operation limit of", max_operations, "exceeded")
+        quit()
+
+
+def count_statement():
+    """
+    Count the statement at next for the operation limit and the metrics
+    """
+    if max_operations is not None and not (check("END") or check("ELSE")):
+        count_operation()
+    if collecting:
+        statement_hits[next] += 1
+
+
+def count_iteration(loop_start):
+    """
+    Count one iteration of the loop at loop_start for the operation
+    limit and the metrics
+    """
+    if max_operations is not None:
+        count_operation()
+    if collecting:
+        iteration_hits[loop_start] += 1
+
+
+def count_skip(opener, start):
+    """
+    Count one block of the statement at opener skipped over, from start
+    up to the next token
+    """
+    skip_hits[opener] += 1
+    skip_tokens[opener] += next - start
+
+
+def count_print(value):
+    """
+    Count one printed value and the characters printed for it
+    """
+    metrics.prints.add()
+    metrics.printed_bytes.add(amount=len(str(value)) + 1)
+
+
+def count_output(output):
+    """
+    Count the values printed by a worker process (see parallel.py),
+    given everything it printed, one value per line
+    """
+    metrics.prints.add(amount=output.count("\n"))
+    metrics.printed_bytes.add(amount=len(output))
+
+
+def run_counts():
+    """
+    Return the runtime metric counts of the program being run, as a
+    list of (metric, label, amount)
+    """
+    result = []
+
+    # Blocks also count the 'end' or 'else' that closes them, which
+    # are not statements
+    for pos, hits in enumerate(statement_hits):
+        if hits and tokens[pos].type not in ("END", "ELSE"):
+            kind = tokens[pos].type
+            if kind == "NAME":
+                kind = "CALL" if tokens[pos + 1].type == "LPAREN" else "ASSIGN"
+            result.append((metrics.statements, kind.lower(), hits))
+
+    for pos, hits in enumerate(iteration_hits):
+        if hits:
+            result.append((metrics.loop_iterations, tokens[pos].type.lower(), hits))
+
+    # Skips are kept by the statement the skipped block belongs to: an
+    # if for a branch not taken, a loop for its exit, and a function
+    # for its definition
+    for pos, hits in enumerate(skip_hits):
+        if hits:
+            kind = tokens[pos].type.lower()
+            result.append((metrics.skips, kind, hits))
+            result.append((metrics.skipped_tokens, kind, skip_tokens[pos]))
+    return result
+
 
 def while_statement():
     """
@@ -230,22 +551,43 @@ def while_statement():
     """
     global next
 
+    loop_start = next
+    compiling = jit_loops and tracer is None and max_operations is None
+
     match("WHILE")
     condition_start = next
     val = condition()
     match("COLON")
+    if tracer is not None:
+        tracer.branch(val)
 
     # simulated while loop
     while val:
+        if counting:
+            count_iteration(loop_start)
+
         block()
 
         # reset to top of loop
         next = condition_start
+
+        # Once the loop is hot, run the rest of it compiled
+        if compiling:
+            loop = jit.hot(tokens, loop_start, symbols, global_symbols)
+            if loop is not None:
+                finished = loop.run_while(symbols, global_symbols)
+                if collecting:
+                    iteration_hits[loop_start] += loop.iterations
+                if finished:
+                    break
+
         val = condition()
         match("COLON")
+        if tracer is not None:
+            tracer.branch(val)
 
     # scan through till corresponding end statement has been reached
-    skip_to_end()
+    skip_to_end(loop_start)
 
     match("END")
 
@@ -255,6 +597,10 @@ def for_statement():
     ForStatement --> 'for' '(' Name ':=' Expression 'to' Expression ')'  block end
     """
     global next
+
+    loop_start = next
+    compiling = jit_loops and tracer is None and max_operations is None
+
     match("FOR")
     match("LPAREN")
     index_var = tokens[next].value  # get the name of the loop variable, not its value
@@ -264,13 +610,43 @@ def for_statement():
     match("RPAREN")
     start_of_block = next
 
+    # Workers cannot share the operation count or the trace, so limited
+    # and traced programs always run serially, as do loops in functions
+    # whose bodies can see two frames
+    if (
+        parallel_loops
+        and call_depth == 0
+        and max_operations is None
+        and tracer is None
+        and symbols[index_var] <= right_expr
+    ):
+        first = symbols[index_var]
+        symbols[index_var] = parallel.run_loop(
+            tokens, start_of_block, symbols, index_var, right_expr, fast_paths
+        )
+        if collecting:
+            iteration_hits[loop_start] += int(symbols[index_var] - first)
+
     while symbols[index_var] <= right_expr:
+        if counting:
+            count_iteration(loop_start)
+
         block()
         next = start_of_block
         symbols[index_var] += 1
 
+        # Once the loop is hot, run the rest of it compiled
+        if compiling:
+            loop = jit.hot(tokens, loop_start, symbols, global_symbols)
+            if loop is not None:
+                finished = loop.run_for(symbols, global_symbols, index_var, right_expr)
+                if collecting:
+                    iteration_hits[loop_start] += loop.iterations
+                if finished:
+                    break
+
     # skip to the outermost end
-    skip_to_end()
+    skip_to_end(loop_start)
     match("END")
 
 
@@ -280,16 +656,20 @@ def if_statement():
     """
     global next
 
+    opener = next
     match("IF")
     val = condition()
     match("COLON")
+    if tracer is not None:
+        tracer.branch(val)
 
     if val:
         block()
 
         depth = 0
+        start = next
         while next < len(tokens):
-            if check("IF") or check("WHILE") or check("FOR"):
+            if opens_block():
                 depth += 1
             elif check("END"):
                 if depth == 0:
@@ -298,15 +678,18 @@ def if_statement():
                     depth -= 1
             next += 1
 
+        if collecting and next > start:
+            count_skip(opener, start)
+
         match("END")
 
     else:
         # skip ahead in token sequence
         depth = 0
+        start = next
 
         while next < len(tokens):
             if check("ELSE") and depth == 0:
-                else_clause()  # we want to evalute this else clause
                 break
 
             elif check("END"):
@@ -315,11 +698,17 @@ def if_statement():
                 else:
                     depth -= 1
 
-            elif check("IF") or check("WHILE") or check("FOR"):
+            elif opens_block():
                 depth += 1
 
             next += 1
 
+        if collecting:
+            count_skip(opener, start)
+
+        if check("ELSE"):
+            else_clause()  # we want to evalute this else clause
+
         match("END")
 
 
@@ -334,13 +723,21 @@ def else_clause():
 
 def assign_statement():
     """
-    AssignStatement --> Name ':=' Expression
+    AssignStatement --> Name ['[' Expression ']'] ':=' Expression
     """
 
     # Get the variable name
     name = tokens[next].value
     match("NAME")
 
+    # Assign one element of an array
+    if tokens[next].type == "LBRACKET":
+        values = array_named(name)
+        i = array_index(values, name)
+        match("ASSIGN")
+        values[i] = array_element(expression())
+        return
+
     # Match the := symbol
     match("ASSIGN")
 
@@ -353,12 +750,154 @@ def assign_statement():
     symbols[name] = expr_value
 
 
+def function_statement():
+    """
+    FunctionStatement --> 'function' Name '(' [Name {',' Name}] ')' ':' Block 'end'
+
+    Defining a function records where its body starts and skips over
+    it. The body is only run when the function is called.
+    """
+    opener = next
+    match("FUNCTION")
+    name = tokens[next].value
+    match("NAME")
+
+    params = []
+    match("LPAREN")
+    if check("NAME"):
+        params.append(tokens[next].value)
+        match("NAME")
+        while check("COMMA"):
+            match("COMMA")
+            params.append(tokens[next].value)
+            match("NAME")
+    match("RPAREN")
+    match("COLON")
+
+    start = next
+    skip_to_end(opener)
+    stop = next
+    match("END")
+
+    pure_functions = {f for f in functions if functions[f].pure}
+    pure = analysis.pure(tokens, start, stop, params, name, pure_functions)
+    callees = {
+        tokens[pos].value
+        for pos in range(start, stop)
+        if tokens[pos].type == "NAME" and tokens[pos + 1].type == "LPAREN"
+    }
+
+    # Functions that call an old definition of this one can no longer
+    # be assumed pure
+    if name in functions:
+        invalidate(name)
+    functions[name] = Function(params, start, pure, callees)
+
+
+def invalidate(name):
+    """
+    Stop memoizing every function that calls name, directly or not
+    """
+    for caller, function in functions.items():
+        if function.pure and name in function.callees:
+            function.pure = False
+            function.cache.clear()
+            invalidate(caller)
+
+
+def call():
+    """
+    Call --> Name '(' [Expression {',' Expression}] ')'
+
+    Arguments are evaluated in the caller's frame, then the body runs
+    in a new frame holding the parameters. Return the value given to
+    return, or 0 if the function ends without one.
+    """
+    global next, symbols, call_depth
+
+    name = tokens[next].value
+    if name not in functions:
+        print("Undefined function", name)
+        quit()
+    function = functions[name]
+    match("NAME")
+
+    args = []
+    match("LPAREN")
+    if not check("RPAREN"):
+        args.append(expression())
+        while check("COMMA"):
+            match("COMMA")
+            args.append(expression())
+    match("RPAREN")
+
+    if len(args) != len(function.params):
+        print("Function", name, "takes", len(function.params), "arguments, got", len(args))
+        quit()
+
+    # Arrays can change between calls, so only plain numbers are
+    # used as cache keys. The types are part of the key so f(1) and
+    # f(1.0) are cached separately.
+    key = None
+    if memoize and function.pure and all(type(a) in (int, float) for a in args):
+        key = tuple((type(a), a) for a in args)
+        if key in function.cache:
+            function.cache.move_to_end(key)
+            return function.cache[key]
+
+    caller_symbols = symbols
+    return_to = next
+    symbols = dict(zip(function.params, args))
+    next = function.start
+    call_depth += 1
+
+    try:
+        block()
+        value = 0
+    except ReturnValue as r:
+        value = r.value
+    except RecursionError:
+        # Report from the outermost call, once the stack has unwound
+        if call_depth > 1:
+            raise
+        print("Recursion too deep in function", name)
+        quit()
+    finally:
+        symbols = caller_symbols
+        next = return_to
+        call_depth -= 1
+
+    if key is not None:
+        function.cache[key] = value
+        if len(function.cache) > MEMO_SIZE:
+            function.cache.popitem(last=False)
+
+    return value
+
+
+def return_statement():
+    """
+    ReturnStatement --> 'return' Expression
+    """
+    match("RETURN")
+    value = expression()
+
+    if call_depth == 0:
+        print("return outside of a function")
+        quit()
+    raise ReturnValue(value)
+
+
 def quit_statement():
     """
     quit -> quit expr
     """
     match("QUIT")
     quit_val = expression()
+    if tracer is not None:
+        tracer.output(quit_val)
+    if collecting:
+        count_print(quit_val)
     print(quit_val)
     quit()
 
@@ -374,25 +913,47 @@ def block():
     Extend this function to add calls to the different statement
     functions.
     """
+    global next
 
     in_block = True
 
     while in_block:
+        if counting:
+            count_statement()
+
+        # Statements with a fused shape skip the generic path
+        fused = fused_statements.get(next)
+        if fused is not None:
+            next = fused(symbols, global_symbols)
+            continue
+
         # The next token determines the statement type
-        if check("INPUT"):
+        kind = tokens[next].type
+        if kind == "NAME":
+            if tokens[next + 1].type == "LPAREN":
+                call()
+            else:
+                assign_statement()
+        elif kind == "INPUT":
             input_statement()
-        elif check("NAME"):
-            assign_statement()
-        elif check("PRINT"):
+        elif kind == "PRINT":
             print_statement()
-        elif check("IF"):
+        elif kind == "IF":
             if_statement()
-        elif check("WHILE"):
+        elif kind == "WHILE":
             while_statement()
-        elif check("FOR"):
+        elif kind == "FOR":
             for_statement()
-        elif check("QUIT"):
+        elif kind == "QUIT":
             quit_statement()
+        elif kind == "ARRAY":
+            array_statement()
+        elif kind == "FILL":
+            fill_statement()
+        elif kind == "FUNCTION":
+            function_statement()
+        elif kind == "RETURN":
+            return_statement()
         else:
             in_block = False
 
@@ -407,6 +968,11 @@ def program():
     match("NAME")
     match("COLON")
 
+    # Imports are resolved by the linker before the program runs
+    if check("IMPORT"):
+        print("Programs with imports must be run with modules.py")
+        quit()
+
     # Process the block of statements
     block()
 
@@ -414,19 +980,112 @@ def program():
     match("END")
 
 
-def interpret(source):
+def reset_loops():
+    """
+    Forget what the JIT and parallel loops learned about the last
+    program's loops, so a new program starts afresh
+    """
+    jit.reset()
+    parallel.reset()
+
+
+def interpret(source, budget=None, limit=None, trace=None, optimize=False, jit=False, fuse=True):
     """
     The interpreter uses the same strategy as the parser, but
     functions may return values representing the results of
     evaluating those parts of the program
+
+    See execute for the other arguments
     """
 
     # Lexical analysis
-    global tokens
-    tokens = lexer.analyze(source)
+    execute(lexer.analyze(source), budget, limit, trace, optimize, jit, fuse)
+
+
+def execute(
+    program_tokens, budget=None, limit=None, trace=None, optimize=False, jit=False, fuse=True
+):
+    """
+    Run a program that has already been lexed, or linked by modules.py
+
+    If budget is given, the program is rejected when its estimated
+    cost is over budget, and otherwise stopped if it runs for more than
+    budget operations. limit sets the runtime operation limit directly.
+
+    trace, if given, records or replays the run (see tracing.py)
+
+    If optimize is True, loops are optimized before the program runs
+    and optimizations describes what was changed (see optimizer.py)
+
+    If jit is True, loops are compiled once they are hot (see jit.py)
+
+    If fuse is True, common statement shapes run through fused
+    handlers (see fusion.py)
+    """
+
+    global tokens, next, symbols, global_symbols, functions, call_depth
+    global tracer, operations, max_operations, optimizations, jit_loops
+    global fast_paths, fused_statements, fused_conditions
+    global collecting, statement_hits, iteration_hits, skip_hits, skip_tokens, counting
+    tokens = program_tokens
+    optimizations = []
+    if optimize:
+        tokens, optimizations = optimizer.optimize(tokens)
+
+    next = 0
+    symbols = global_symbols = {}
+    functions = {}
+    call_depth = 0
+    tracer = trace
+    jit_loops = jit
+
+    reset_loops()
+
+    # Fuse after optimizing, since the optimizer makes a new token list
+    fast_paths = fuse
+    fused_statements, fused_conditions = {}, {}
+    if fuse:
+        fused_statements, fused_conditions = fusion.fuse(tokens)
+    operations = 0
+    max_operations = limit
+    collecting = metrics.enabled
+    if collecting:
+        statement_hits = [0] * len(tokens)
+        iteration_hits = [0] * len(tokens)
+        skip_hits = [0] * len(tokens)
+        skip_tokens = [0] * len(tokens)
+
+    # Admission check against the static cost estimate
+    if budget is not None:
+        estimate = cost.estimate(tokens)
+        if estimate.operations > budget:
+            print("Program rejected:", estimate, "over budget of", budget)
+            quit()
+
+        if max_operations is None:
+            max_operations = budget
+
+    counting = max_operations is not None or collecting
+
+    # Deep recursion in the program needs a deeper Python stack, but
+    # only while it runs
+    recursion_limit = sys.getrecursionlimit()
+    if recursion_limit < RECURSION_LIMIT:
+        sys.setrecursionlimit(RECURSION_LIMIT)
 
     # Start with the top-level declaration
-    program()
+    start = time.perf_counter()
+    if collecting:
+        metrics.begin(run_counts)
+    try:
+        program()
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+        if tracer is not None:
+            tracer.finish()
+        if collecting:
+            metrics.finish()
+            metrics.phase("execute", start)
 
 
 ### Main
@@ -0,0 +1,519 @@
+"""
+Hot loop compiler for compiler
+
+The interpreter counts the iterations of every while and for loop.
+Once a loop has run HOT_THRESHOLD iterations, its condition and body
+are compiled into a tree of Python closures, one per statement and
+expression, which then run the remaining iterations without walking
+the tokens again.
+
+A compiled loop is specialized for the frame it was compiled in: each
+variable it uses is bound to the local or global frame and its type is
+recorded. Before every iteration a guard checks these are unchanged.
+If not, the compiled loop returns and the interpreter carries on from
+the top of the loop, and the loop can be compiled again later for the
+new types.
+
+Loops containing input, quit, function calls or definitions, return
+or array declarations are never compiled.
+"""
+
+import analysis, operator
+
+# Iterations a loop runs in the interpreter before it is compiled
+HOT_THRESHOLD = 50
+
+# Iteration counts and compiled loops of the program being run, keyed
+# by the position of the loop
+counts = {}
+compiled = {}
+
+RELOPS = {
+    "EQUALS": operator.eq,
+    "NOT_EQUAL": operator.ne,
+    "GREATER_THAN": operator.gt,
+    "LESS_THAN": operator.lt,
+    "GREATER_THAN_OR_EQUAL": operator.ge,
+    "LESS_THAN_OR_EQUAL": operator.le,
+}
+
+
+class NotCompilable(Exception):
+    """
+    Raised when a loop uses something the compiler does not handle
+    """
+
+
+class Loop:
+    """
+    Class that represents a compiled while or for loop
+
+    self.condition is the compiled while condition, or None for a for
+    loop. self.body runs one iteration. self.guards lists the
+    (name, type, local) bindings the loop was specialized for.
+    self.iterations is the number of iterations the last run_while or
+    run_for ran.
+    """
+
+    def __init__(self, condition, body, guards):
+        self.condition = condition
+        self.body = body
+        self.guards = guards
+        self.iterations = 0
+
+    def guard(self, f, g):
+        """
+        Check that every variable still has the frame and type the
+        loop was compiled for
+        """
+        for name, kind, local in self.guards:
+            if local:
+                if name not in f or type(f[name]) is not kind:
+                    return False
+            elif name in f or name not in g or type(g[name]) is not kind:
+                return False
+        return True
+
+    def run_while(self, f, g):
+        """
+        Run the rest of a while loop
+
+        Return True if the loop finished, or False if a guard failed and
+        the interpreter should continue from the top of the loop
+        """
+        condition = self.condition
+        body = self.body
+        iterations = 0
+
+        try:
+            while self.guard(f, g):
+                if not condition(f, g):
+                    return True
+                body(f, g)
+                iterations += 1
+            return False
+        finally:
+            self.iterations = iterations
+
+    def run_for(self, f, g, index_var, last):
+        """
+        Run the rest of a for loop up to last
+
+        Return True if the loop finished, or False if a guard failed and
+        the interpreter should continue from the top of the loop
+        """
+        body = self.body
+        first = f[index_var]
+
+        try:
+            while f[index_var] <= last:
+                if not self.guard(f, g):
+                    return False
+                body(f, g)
+                f[index_var] += 1
+            return True
+        finally:
+            self.iterations = f[index_var] - first
+
+
+def reset():
+    """
+    Forget the loops of the last program, before a new one runs
+    """
+    counts.clear()
+    compiled.clear()
+
+
+def hot(tokens, pos, f, g):
+    """
+    Count one iteration of the loop at pos
+
+    Return the compiled loop once the loop is hot and could be compiled
+    for the current frames, otherwise None
+    """
+    if pos in compiled:
+        loop = compiled[pos]
+        if loop is not None and loop.guard(f, g):
+            return loop
+        if loop is None:
+            return None
+
+    counts[pos] = counts.get(pos, 0) + 1
+    if counts[pos] < HOT_THRESHOLD:
+        return None
+
+    # Compile, or recompile after a guard failed, and start counting
+    # again so a loop that keeps failing its guards is not recompiled
+    # on every iteration
+    counts[pos] = 0
+    try:
+        loop = compile_loop(tokens, pos, f, g)
+    except NotCompilable:
+        loop = None
+    compiled[pos] = loop
+    return loop
+
+
+def compile_loop(tokens, pos, f, g):
+    """
+    Compile the while or for loop at pos for the frames f and g
+    """
+    end = analysis.find_end(tokens, pos + 1)
+
+    for t in tokens[pos:end]:
+        if t.type in ("INPUT", "QUIT", "FUNCTION", "RETURN", "ARRAY"):
+            raise NotCompilable(t.type)
+
+    compiler = Compiler(tokens, f, g)
+
+    # Every variable the loop assigns must already be in the local
+    # frame, so reads of it always resolve there
+    for name in analysis.assigned_names(tokens, pos, end):
+        if name not in f:
+            raise NotCompilable(name)
+        compiler.bind(name)
+
+    if tokens[pos].type == "WHILE":
+        condition, body_start = compiler.condition(pos + 1)
+        body = compiler.block(body_start + 1, end)
+    else:
+        condition = None
+        body = compiler.block(analysis.find_close(tokens, pos + 1), end)
+
+    guards = [(name, kind, local) for name, (kind, local) in compiler.bindings.items()]
+    return Loop(condition, body, guards)
+
+
+class Compiler:
+    """
+    Class that compiles statements and expressions into closures
+
+    Every closure takes the local frame f and the global frame g.
+    self.bindings maps each variable used to its type and whether it
+    is read from the local frame.
+    """
+
+    def __init__(self, tokens, f, g):
+        import interpreter
+
+        self.tokens = tokens
+        self.f = f
+        self.g = g
+        self.bindings = {}
+        self.interpreter = interpreter
+
+    def bind(self, name):
+        """
+        Record the frame and type of a variable, return True if it is local
+        """
+        if name not in self.bindings:
+            if name in self.f:
+                self.bindings[name] = (type(self.f[name]), True)
+            elif name in self.g:
+                self.bindings[name] = (type(self.g[name]), False)
+            else:
+                raise NotCompilable(name)
+        return self.bindings[name][1]
+
+    def block(self, pos, stop):
+        """
+        Block --> {Statement}
+        """
+        statements = []
+
+        while pos < stop and self.tokens[pos].type not in ("END", "ELSE"):
+            statement, pos = self.statement(pos)
+            statements.append(statement)
+
+        statements = tuple(statements)
+
+        if len(statements) == 1:
+            return statements[0]
+
+        def run(f, g):
+            for statement in statements:
+                statement(f, g)
+
+        return run
+
+    def statement(self, pos):
+        """
+        Compile the statement at pos, return it and the position after it
+        """
+        tokens = self.tokens
+        kind = tokens[pos].type
+
+        if kind == "NAME" and tokens[pos + 1].type == "LBRACKET":
+            return self.element_assign(pos)
+        elif kind == "NAME" and tokens[pos + 1].type == "ASSIGN":
+            return self.assign(pos)
+        elif kind == "PRINT":
+            return self.print_statement(pos)
+        elif kind == "IF":
+            return self.if_statement(pos)
+        elif kind == "WHILE":
+            return self.while_statement(pos)
+        elif kind == "FOR":
+            return self.for_statement(pos)
+        elif kind == "FILL":
+            return self.fill_statement(pos)
+        raise NotCompilable(kind)
+
+    def assign(self, pos):
+        """
+        AssignStatement --> Name ':=' Expression
+        """
+        name = self.tokens[pos].value
+        value, pos = self.expression(pos + 2)
+
+        def run(f, g):
+            f[name] = value(f, g)
+
+        return run, pos
+
+    def element_assign(self, pos):
+        """
+        AssignStatement --> Name '[' Expression ']' ':=' Expression
+        """
+        values = self.array(pos)
+        index, pos = self.index(pos)
+        value, pos = self.expression(pos + 1)
+        array_element = self.interpreter.array_element
+
+        def run(f, g):
+            target = values(f, g)
+            i = index(f, g, target)
+            target[i] = array_element(value(f, g))
+
+        return run, pos
+
+    def print_statement(self, pos):
+        """
+        PrintStatement --> 'print' Expression
+        """
+        value, pos = self.expression(pos + 1)
+
+        if not self.interpreter.collecting:
+
+            def run(f, g):
+                print(value(f, g))
+
+            return run, pos
+
+        count_print = self.interpreter.count_print
+
+        def run(f, g):
+            result = value(f, g)
+            count_print(result)
+            print(result)
+
+        return run, pos
+
+    def fill_statement(self, pos):
+        """
+        FillStatement --> 'fill' Name ':=' Expression
+        """
+        values = self.array(pos + 1)
+        value, pos = self.expression(pos + 3)
+        array_element = self.interpreter.array_element
+        array_type = self.interpreter.array.array
+
+        def run(f, g):
+            target = values(f, g)
+            target[:] = array_type("q", [array_element(value(f, g))]) * len(target)
+
+        return run, pos
+
+    def if_statement(self, pos):
+        """
+        IfStatement --> 'if' Condition ':' Block ['else' ':' Block] 'end'
+        """
+        end = analysis.find_end(self.tokens, pos + 1)
+        test, pos = self.condition(pos + 1)
+        else_pos = analysis.else_position(self.tokens, pos + 1, end)
+
+        then_block = self.block(pos + 1, else_pos)
+        if else_pos < end:
+            else_block = self.block(else_pos + 2, end)
+        else:
+            else_block = None
+
+        def run(f, g):
+            if test(f, g):
+                then_block(f, g)
+            elif else_block is not None:
+                else_block(f, g)
+
+        return run, end + 1
+
+    def while_statement(self, pos):
+        """
+        WhileStatement --> 'while' Condition ':' Block 'end'
+        """
+        end = analysis.find_end(self.tokens, pos + 1)
+        test, pos = self.condition(pos + 1)
+        body = self.block(pos + 1, end)
+
+        def run(f, g):
+            while test(f, g):
+                body(f, g)
+
+        return run, end + 1
+
+    def for_statement(self, pos):
+        """
+        ForStatement --> 'for' '(' Name ':=' Expression 'to' Expression ')' Block 'end'
+        """
+        end = analysis.find_end(self.tokens, pos + 1)
+        index_var = self.tokens[pos + 2].value
+        first, pos = self.expression(pos + 4)
+        last, pos = self.expression(pos + 1)
+        body = self.block(pos + 1, end)
+
+        def run(f, g):
+            f[index_var] = first(f, g)
+            bound = last(f, g)
+            while f[index_var] <= bound:
+                body(f, g)
+                f[index_var] += 1
+
+        return run, end + 1
+
+    def condition(self, pos):
+        """
+        Condition --> Expression RelOp Expression
+
+        Return the compiled condition and the position of the ':' after it
+        """
+        lhs, pos = self.expression(pos)
+        if self.tokens[pos].type not in RELOPS:
+            raise NotCompilable(self.tokens[pos].type)
+        op = RELOPS[self.tokens[pos].type]
+        rhs, pos = self.expression(pos + 1)
+
+        def run(f, g):
+            return op(lhs(f, g), rhs(f, g))
+
+        return run, pos
+
+    def expression(self, pos):
+        """
+        Expression --> Term [('+' | '-') Expression]
+        """
+        first, pos = self.term(pos)
+        kind = self.tokens[pos].type
+
+        if kind == "PLUS":
+            rest, pos = self.expression(pos + 1)
+            return (lambda f, g: first(f, g) + rest(f, g)), pos
+        elif kind == "MINUS":
+            rest, pos = self.expression(pos + 1)
+            return (lambda f, g: first(f, g) - rest(f, g)), pos
+        return first, pos
+
+    def term(self, pos):
+        """
+        Term --> Factor [( '*' | '/' ) Factor]
+        """
+        first, pos = self.factor(pos)
+        kind = self.tokens[pos].type
+
+        if kind == "MULTIPLY":
+            second, pos = self.factor(pos + 1)
+            return (lambda f, g: first(f, g) * second(f, g)), pos
+        elif kind == "DIVIDE":
+            second, pos = self.factor(pos + 1)
+            return (lambda f, g: first(f, g) / second(f, g)), pos
+        return first, pos
+
+    def factor(self, pos):
+        """
+        Factor --> '-' Factor | Atom
+        """
+        if self.tokens[pos].type == "MINUS":
+            value, pos = self.factor(pos + 1)
+            return (lambda f, g: -1 * value(f, g)), pos
+        return self.atom(pos)
+
+    def atom(self, pos):
+        """
+        Atom --> Name ['[' Expression ']']
+         | Number
+         | '(' Expression ')'
+         | ('length' | 'sum') '(' Name ')'
+        """
+        tokens = self.tokens
+        kind = tokens[pos].type
+
+        if kind == "NAME" and tokens[pos + 1].type == "LBRACKET":
+            values = self.array(pos)
+            index, pos = self.index(pos)
+
+            def run(f, g):
+                target = values(f, g)
+                return target[index(f, g, target)]
+
+            return run, pos
+
+        elif kind == "NAME" and tokens[pos + 1].type == "LPAREN":
+            raise NotCompilable("call")
+
+        elif kind == "NAME":
+            return self.variable(pos), pos + 1
+
+        elif kind == "NUMBER":
+            number = tokens[pos].value
+            return (lambda f, g: number), pos + 1
+
+        elif kind == "LPAREN":
+            value, pos = self.expression(pos + 1)
+            return value, pos + 1
+
+        elif kind in ("LENGTH", "SUM"):
+            values = self.array(pos + 2)
+            if kind == "LENGTH":
+                return (lambda f, g: len(values(f, g))), pos + 4
+            return (lambda f, g: sum(values(f, g))), pos + 4
+
+        raise NotCompilable(kind)
+
+    def variable(self, pos):
+        """
+        Compile a read of the variable at pos
+        """
+        name = self.tokens[pos].value
+        if self.bind(name):
+            return lambda f, g: f[name]
+        return lambda f, g: g[name]
+
+    def array(self, pos):
+        """
+        Compile a read of the array named at pos
+
+        The guard checks the variable still holds an array
+        """
+        name = self.tokens[pos].value
+        self.bind(name)
+        if self.bindings[name][0] is not self.interpreter.array.array:
+            raise NotCompilable(name)
+        return self.variable(pos)
+
+    def index(self, pos):
+        """
+        Index --> '[' Expression ']'
+
+        pos is the position of the array name. Return a closure that
+        evaluates and checks the index for a given array, and the
+        position after the ']'.
+        """
+        name = self.tokens[pos].value
+        value, pos = self.expression(pos + 2)
+
+        def run(f, g, values):
+            i = value(f, g)
+            if type(i) is not int or not 0 <= i < len(values):
+                print("Index", i, "out of range for array", name)
+                quit()
+            return i
+
+        return run, pos + 1
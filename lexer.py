@@ -2,7 +2,54 @@
 Lexical analyzer for compiler
 """
 
-import sys
+import metrics, sys, time
+
+# Words that are only keywords where a variable could not appear, so
+# programs can still use them as variable names: 'length' and 'sum'
+# when followed by '(', 'module' and 'import' in the header of a unit,
+# the others when they start a statement
+CONTEXTUAL = {
+    "length": "LENGTH",
+    "sum": "SUM",
+    "array": "ARRAY",
+    "fill": "FILL",
+    "function": "FUNCTION",
+    "return": "RETURN",
+    "module": "MODULE",
+    "import": "IMPORT",
+}
+
+# Tokens after which an operand or a name is expected, so a contextual
+# word that follows them is a variable
+OPERAND_EXPECTED = (
+    "ASSIGN",
+    "PLUS",
+    "MINUS",
+    "MULTIPLY",
+    "DIVIDE",
+    "LPAREN",
+    "LBRACKET",
+    "COMMA",
+    "EQUALS",
+    "NOT_EQUAL",
+    "LESS_THAN",
+    "LESS_THAN_OR_EQUAL",
+    "GREATER_THAN",
+    "GREATER_THAN_OR_EQUAL",
+    "TO",
+    "IF",
+    "WHILE",
+    "PRINT",
+    "QUIT",
+    "RETURN",
+    "INPUT",
+    "ARRAY",
+    "FILL",
+    "FUNCTION",
+    "PROGRAM",
+    "MODULE",
+    "IMPORT",
+)
 
 
 class Token:
@@ -34,6 +81,7 @@ def analyze(s):
     Return a list of the tokens identified in s
     """
 
+    start = time.perf_counter()
     tokens = []
 
     next = 0
@@ -90,6 +138,20 @@ def analyze(s):
             tokens.append(Token("RPAREN", ")"))
             next += 1
 
+        # recognize commas separating function arguments
+        elif s[next] == ",":
+            tokens.append(Token("COMMA", ","))
+            next += 1
+
+        # recognize brackets for array indexing
+        elif s[next] == "[":
+            tokens.append(Token("LBRACKET", "["))
+            next += 1
+
+        elif s[next] == "]":
+            tokens.append(Token("RBRACKET", "]"))
+            next += 1
+
         # recgonize a colon :
         elif s[next] == ":":
             if next < len(s) - 1 and s[next + 1] == "=":
@@ -158,9 +220,60 @@ def analyze(s):
     #        pad = line_size - len(token.type) + len(str(token.value))
     #        f.write(str(token) + (pad * " ") + str(count) + "\n")
 
+    contextual_keywords(tokens)
+
+    if metrics.enabled:
+        metrics.tokens_lexed.add(amount=len(tokens))
+        metrics.phase("lex", start)
+
     return tokens
 
 
+def contextual_keywords(tokens):
+    """
+    Turn the names in CONTEXTUAL into keywords where they are used as
+    keywords
+
+    'length' and 'sum' are builtins when they are called. 'module'
+    starts a unit, and 'import' followed by a name comes right after
+    the unit's header or another import. The others start a statement
+    when they do not come where an operand is expected, and are not
+    followed by ':=' or '[' as a variable at the start of a statement
+    is: 'array' and 'fill' when they are followed by a name, 'function'
+    by a name and '(', and 'return' by anything else.
+    """
+    for pos, t in enumerate(tokens):
+        if t.type != "NAME" or t.value not in CONTEXTUAL or pos + 1 >= len(tokens):
+            continue
+
+        following = tokens[pos + 1].type
+        operand = pos > 0 and tokens[pos - 1].type in OPERAND_EXPECTED
+        if t.value in ("length", "sum"):
+            keyword = following == "LPAREN"
+        elif t.value == "function":
+            keyword = (
+                not operand
+                and following == "NAME"
+                and pos + 2 < len(tokens)
+                and tokens[pos + 2].type == "LPAREN"
+            )
+        elif t.value == "return":
+            keyword = not operand and following not in ("ASSIGN", "LBRACKET")
+        elif t.value == "module":
+            keyword = pos == 0
+        elif t.value == "import":
+            keyword = (
+                following == "NAME"
+                and tokens[0].type in ("PROGRAM", "MODULE")
+                and (pos == 3 or tokens[pos - 2].type == "IMPORT")
+            )
+        else:
+            keyword = not operand and following == "NAME"
+
+        if keyword:
+            t.type = CONTEXTUAL[t.value]
+
+
 ### Main
 if __name__ == "__main__":
     # The name of the test file is the first command line argument
@@ -0,0 +1,272 @@
+"""
+Runtime metrics for compiler
+
+Operational counters kept by the lexer, parser and interpreter while
+metrics are enabled: tokens lexed, statements executed by kind, loop
+iterations, blocks skipped over and the tokens walked to skip them,
+input and print volume, and the time spent lexing, parsing and
+executing.
+
+The counters can be read in process with snapshot(), rendered in the
+Prometheus text format with render(), and written to a file every few
+seconds by start_export().
+
+Metrics are off by default. The interpreter only checks whether they
+are on once per run, and every counter in its hot paths sits behind
+that single flag, so disabled metrics cost one test per statement.
+While a program runs, the interpreter counts statements, iterations
+and skips by token position, which is cheaper than counting by kind,
+and the counts are sorted into kinds when they are read. Loops run by
+compiled code (see jit.py) or by worker processes (see parallel.py)
+count their iterations and prints but not the other statements inside
+them.
+"""
+
+import atexit, collections, os, sys, threading, time
+
+# Prefix of every exported metric name
+PREFIX = "interpreter_"
+
+# Seconds between dumps written by the exporter
+EXPORT_INTERVAL = 10.0
+
+# Whether the lexer, parser and interpreter count anything
+enabled = False
+
+
+class Metric:
+    """
+    Class that represents one counter, optionally split by a label
+
+    self.values maps each label value to its count. Unlabeled counters
+    keep their count under None.
+    """
+
+    def __init__(self, name, help, label=None):
+        self.name = PREFIX + name
+        self.help = help
+        self.label = label
+        self.values = collections.Counter()
+
+    def add(self, label=None, amount=1):
+        """
+        Add amount to the count for label
+        """
+        self.values[label] += amount
+
+
+tokens_lexed = Metric("tokens_lexed_total", "Tokens produced by the lexer.")
+statements = Metric("statements_executed_total", "Statements executed by the interpreter.", "kind")
+loop_iterations = Metric("loop_iterations_total", "Loop iterations run.", "loop")
+skips = Metric(
+    "blocks_skipped_total",
+    "Blocks skipped over, by statement: branches not taken for if, exits for while and for, "
+    "definitions for function.",
+    "statement",
+)
+skipped_tokens = Metric("skipped_tokens_total", "Tokens walked while skipping blocks.", "statement")
+inputs = Metric("inputs_total", "Values read by input statements.")
+prints = Metric("prints_total", "Values printed by print and quit statements.")
+printed_bytes = Metric("printed_bytes_total", "Characters printed, including newlines.")
+phase_seconds = Metric("phase_seconds_total", "Time spent in each phase.", "phase")
+
+METRICS = [
+    tokens_lexed,
+    statements,
+    loop_iterations,
+    skips,
+    skipped_tokens,
+    inputs,
+    prints,
+    printed_bytes,
+    phase_seconds,
+]
+
+# Function returning the counts of the program being run, as a list
+# of (metric, label, amount), or None when no program is running
+pending = None
+
+# Held while the counts of a finished run are added to the metrics, so
+# a snapshot never sees them both pending and added
+lock = threading.Lock()
+
+# The background thread writing dumps, and the event that stops it
+exporter = None
+stopping = None
+
+
+def enable():
+    """
+    Start counting
+    """
+    global enabled
+    enabled = True
+
+
+def disable():
+    """
+    Stop counting, keeping the counts so far
+    """
+    global enabled
+    enabled = False
+
+
+def reset():
+    """
+    Set every counter back to zero
+    """
+    for metric in METRICS:
+        metric.values.clear()
+
+
+def begin(counts):
+    """
+    Start including the counts returned by the function counts in
+    every snapshot, until finish is called
+    """
+    global pending
+    pending = counts
+
+
+def finish():
+    """
+    Add the counts of the run that just finished to the metrics
+    """
+    global pending
+
+    with lock:
+        for metric, label, amount in pending():
+            metric.add(label, amount)
+        pending = None
+
+
+def phase(name, start):
+    """
+    Add the time since start, a time.perf_counter() value, to a phase
+    """
+    phase_seconds.add(name, time.perf_counter() - start)
+
+
+def snapshot():
+    """
+    Return the current counts
+
+    The result maps each metric name to its count, or for labeled
+    metrics to a dictionary from label value to count
+    """
+    with lock:
+        # Copying a dictionary cannot be interrupted by another thread
+        counts = {metric: collections.Counter(dict(metric.values)) for metric in METRICS}
+        if pending is not None:
+            for metric, label, amount in pending():
+                counts[metric][label] += amount
+
+    result = {}
+    for metric in METRICS:
+        if metric.label is None:
+            result[metric.name] = counts[metric].get(None, 0)
+        else:
+            result[metric.name] = dict(counts[metric])
+    return result
+
+
+def format_value(value):
+    """
+    Return a count as Prometheus writes it
+    """
+    if type(value) is float:
+        return repr(value)
+    return str(value)
+
+
+def render():
+    """
+    Return the current counts in the Prometheus text exposition format
+    """
+    lines = []
+    counts = snapshot()
+
+    for metric in METRICS:
+        lines.append("# HELP %s %s" % (metric.name, metric.help))
+        lines.append("# TYPE %s counter" % metric.name)
+
+        if metric.label is None:
+            lines.append("%s %s" % (metric.name, format_value(counts[metric.name])))
+            continue
+
+        for label, value in sorted(counts[metric.name].items()):
+            lines.append('%s{%s="%s"} %s' % (metric.name, metric.label, label, format_value(value)))
+
+    return "\n".join(lines) + "\n"
+
+
+def dump(path):
+    """
+    Write the current counts to path in the Prometheus text format
+
+    The file is replaced in one step so a scraper never reads half a dump
+    """
+    with open(path + ".tmp", "w") as f:
+        f.write(render())
+    os.replace(path + ".tmp", path)
+
+
+def start_export(path, interval=EXPORT_INTERVAL):
+    """
+    Enable metrics and dump them to path every interval seconds, and
+    once more when the exporter is stopped or the process exits
+    """
+    global exporter, stopping
+
+    stop_export()
+    enable()
+
+    stopping = threading.Event()
+
+    def export(stopping):
+        while not stopping.wait(interval):
+            dump(path)
+        dump(path)
+
+    exporter = threading.Thread(target=export, args=(stopping,), name="metrics-export", daemon=True)
+    exporter.start()
+
+
+def stop_export():
+    """
+    Stop the exporter, if one is running, after its final dump
+    """
+    global exporter
+
+    if exporter is None:
+        return
+
+    stopping.set()
+    exporter.join()
+    exporter = None
+
+
+atexit.register(stop_export)
+
+
+### Main
+if __name__ == "__main__":
+    # The interpreter counts into the imported module, not into this
+    # script, so everything goes through that module
+    import interpreter, metrics
+
+    # The name of the program file is the first command line argument,
+    # optionally followed by a file to export the metrics to
+    filename = sys.argv[1]
+
+    if len(sys.argv) > 2:
+        metrics.start_export(sys.argv[2])
+    else:
+        metrics.enable()
+
+    source = open(filename).read()
+    try:
+        interpreter.interpret(source)
+    finally:
+        if len(sys.argv) <= 2:
+            sys.stderr.write(metrics.render())
@@ -0,0 +1,296 @@
+"""
+Separate compilation and linking for compiler
+
+A program can be split across files. Each file holds one unit, either
+the program or a module:
+
+    Module --> 'module' Name ':' {ImportStatement} Block 'end'
+    ImportStatement --> 'import' Name
+
+'import Name' refers to the module in Name.p, looked up first next to
+the importing file and then in each directory of path.
+
+Each unit is compiled on its own (lexed, parsed and checked that every
+function it calls is defined in it or in a module it imports) and the
+result is cached as JSON in a __pcache__ directory next to the source.
+A unit is only compiled again when its source changes or when one of
+the modules it imports, directly or not, is compiled again.
+
+Linking joins the cached units into one program: the body of every
+imported module, each once and in dependency order, followed by the
+body of the program. Unchanged units are never lexed or parsed again.
+"""
+
+import hashlib, json, os, sys
+import analysis, interpreter, lexer, parser
+
+# Bump when the artifact layout changes so old caches are ignored
+ARTIFACT_VERSION = 2
+
+CACHE_DIR = "__pcache__"
+
+# Every field of an artifact and its type in the cache file. The body is
+# stored as a list of [type, value] pairs, one per token.
+FIELDS = {
+    "version": int,
+    "kind": str,
+    "name": str,
+    "path": str,
+    "source_hash": str,
+    "fingerprint": str,
+    "imports": list,
+    "exports": list,
+    "body": list,
+}
+
+# Extra directories searched for imported modules
+path = []
+
+# Names of the units compiled and loaded from the cache by the last build
+compiled = []
+cached = []
+
+
+def resolve(name, importer):
+    """
+    Return the file holding the module called name, imported from the
+    file importer
+    """
+    for directory in [os.path.dirname(importer)] + path:
+        candidate = os.path.join(directory, name + ".p")
+        if os.path.exists(candidate):
+            return os.path.abspath(candidate)
+
+    print("Cannot find module", name, "imported by", importer)
+    quit()
+
+
+def artifact_path(source_path):
+    """
+    Return where the artifact for a source file is cached
+    """
+    directory, filename = os.path.split(source_path)
+    return os.path.join(directory, CACHE_DIR, os.path.splitext(filename)[0] + ".json")
+
+
+def read_artifact(source_path):
+    """
+    Return the cached artifact for a source file, or None
+
+    A cache file that cannot be read or does not hold an artifact of
+    this version counts as missing, so the unit is compiled again
+    """
+    try:
+        with open(artifact_path(source_path), encoding="utf-8") as f:
+            artifact = json.load(f)
+
+        if artifact.get("version") != ARTIFACT_VERSION:
+            return None
+        for field, kind in FIELDS.items():
+            if type(artifact[field]) is not kind:
+                return None
+        if not all(type(name) is str for name in artifact["imports"] + artifact["exports"]):
+            return None
+
+        artifact["body"] = [lexer.Token(kind, value) for kind, value in artifact["body"]]
+    except (OSError, ValueError, AttributeError, KeyError, TypeError):
+        return None
+
+    return artifact
+
+
+def write_artifact(source_path, artifact):
+    """
+    Save an artifact next to its source file
+    """
+    target = artifact_path(source_path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    artifact = dict(artifact, body=[[t.type, t.value] for t in artifact["body"]])
+
+    # Write to a temporary file first so a reader never sees half an artifact
+    with open(target + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(artifact, f)
+    os.replace(target + ".tmp", target)
+
+
+def imports(tokens):
+    """
+    Return the names imported at the start of a unit
+    """
+    names = []
+    pos = 3
+    while tokens[pos].type == "IMPORT":
+        names.append(tokens[pos + 1].value)
+        pos += 2
+    return names
+
+
+def compile_unit(source_path, tokens, source_hash, fingerprint, deps):
+    """
+    Compile one unit into an artifact
+
+    The artifact holds the unit's body, with the header, imports and
+    closing 'end' removed, the functions it makes available to units
+    that import it, and what it was compiled from
+    """
+    # Check the syntax, quietly since this is not a parser run
+    parser.verbose = False
+    try:
+        parser.parse(list(tokens))
+    finally:
+        parser.verbose = True
+
+    kind = tokens[0].type
+    name = tokens[1].value
+    names = imports(tokens)
+    body = tokens[3 + 2 * len(names) : -1]
+
+    # Every function called must be defined here or in an import
+    defined = {body[pos + 1].value for pos in range(len(body)) if body[pos].type == "FUNCTION"}
+    visible = set(defined)
+    for dep in deps:
+        visible |= set(dep["exports"])
+
+    for pos in range(len(body) - 1):
+        if body[pos].type == "NAME" and body[pos + 1].type == "LPAREN":
+            if body[pos].value not in visible:
+                print("Undefined function", body[pos].value, "in", source_path)
+                quit()
+
+    # Functions defined at the top level are exported, along with
+    # everything the unit's own imports export
+    exports = {
+        body[pos + 1].value
+        for pos in analysis.statements(body, 0, len(body))
+        if body[pos].type == "FUNCTION"
+    }
+    for dep in deps:
+        exports |= set(dep["exports"])
+
+    return {
+        "version": ARTIFACT_VERSION,
+        "kind": kind,
+        "name": name,
+        "path": source_path,
+        "source_hash": source_hash,
+        "fingerprint": fingerprint,
+        "imports": names,
+        "exports": sorted(exports),
+        "body": body,
+    }
+
+
+def load(source_path, loaded, loading):
+    """
+    Return the artifact for a source file, compiling it and the modules
+    it imports if they are out of date
+
+    loaded maps each source file already handled by this build to its
+    artifact. loading lists the files whose imports are being resolved,
+    to catch import cycles.
+    """
+    if source_path in loaded:
+        return loaded[source_path]
+
+    if source_path in loading:
+        print("Import cycle:", " -> ".join(loading + [source_path]))
+        quit()
+
+    with open(source_path) as f:
+        source = f.read()
+    source_hash = hashlib.sha256(source.encode()).hexdigest()
+
+    # An unchanged source does not need lexing to find its imports
+    artifact = read_artifact(source_path)
+    tokens = None
+    if artifact is not None and artifact["source_hash"] == source_hash:
+        names = artifact["imports"]
+    else:
+        tokens = lexer.analyze(source)
+        if tokens[0].type not in ("PROGRAM", "MODULE") or len(tokens) < 4:
+            print(source_path, "does not start with 'program' or 'module'")
+            quit()
+        names = imports(tokens)
+
+    deps = [
+        load(resolve(name, source_path), loaded, loading + [source_path])
+        for name in names
+    ]
+
+    # The fingerprint changes when this unit or anything it imports changes
+    fingerprint = hashlib.sha256(
+        (source_hash + "".join(dep["fingerprint"] for dep in deps)).encode()
+    ).hexdigest()
+
+    if artifact is not None and artifact["fingerprint"] == fingerprint:
+        cached.append(artifact["name"])
+    else:
+        if tokens is None:
+            tokens = lexer.analyze(source)
+        artifact = compile_unit(source_path, tokens, source_hash, fingerprint, deps)
+        write_artifact(source_path, artifact)
+        compiled.append(artifact["name"])
+
+    loaded[source_path] = artifact
+    return artifact
+
+
+def order(artifact, loaded, done, result):
+    """
+    Append artifact after everything it imports to result, each unit once
+    """
+    if artifact["path"] in done:
+        return
+    done.add(artifact["path"])
+
+    for name in artifact["imports"]:
+        order(loaded[resolve(name, artifact["path"])], loaded, done, result)
+    result.append(artifact)
+
+
+def link(source_path):
+    """
+    Build a program and its modules, and return the linked token list
+    """
+    compiled.clear()
+    cached.clear()
+
+    source_path = os.path.abspath(source_path)
+    loaded = {}
+    main = load(source_path, loaded, [])
+
+    if main["kind"] != "PROGRAM":
+        print(source_path, "is a module, not a program")
+        quit()
+
+    units = []
+    order(main, loaded, set(), units)
+
+    tokens = [lexer.Token("PROGRAM", "program"), lexer.Token("NAME", main["name"]), lexer.Token("COLON", ":")]
+    for unit in units:
+        if unit is not main and unit["kind"] != "MODULE":
+            print(unit["path"], "is a program and cannot be imported")
+            quit()
+        tokens.extend(unit["body"])
+    tokens.append(lexer.Token("END", "end"))
+
+    return tokens
+
+
+def run(source_path, **options):
+    """
+    Link and run a program, options are passed to interpreter.execute
+    """
+    interpreter.execute(link(source_path), **options)
+
+
+### Main
+if __name__ == "__main__":
+    # The name of the program file is the first command line argument
+    filename = sys.argv[1]
+    run(filename)
+
+    if "-v" in sys.argv:
+        print("compiled:", " ".join(compiled), file=sys.stderr)
+        print("cached:", " ".join(cached), file=sys.stderr)
@@ -0,0 +1,290 @@
+"""
+Loop optimizer for compiler
+
+Rewrites the token list before it is interpreted:
+
+- for loops with a small constant number of iterations are unrolled
+  into a copy of the body per iteration, so the loop test and increment
+  disappear
+- expressions in a loop body that only use variables the loop never
+  assigns are computed once before the loop and kept in a temporary
+
+Both transformations keep the program's output unchanged.
+"""
+
+import analysis, lexer, sys
+
+# Unroll for loops with at most this many iterations, as long as the
+# unrolled body stays under UNROLL_TOKENS tokens
+UNROLL_LIMIT = 16
+UNROLL_TOKENS = 256
+
+# Tokens allowed in an expression that is hoisted out of a loop. Division
+# is left alone so a hoisted expression never raises an error the loop
+# itself would not have.
+HOISTABLE = ("NAME", "NUMBER", "PLUS", "MINUS", "MULTIPLY", "LPAREN", "RPAREN")
+
+
+def optimize(tokens):
+    """
+    Optimize the loops in a program
+
+    Return the new token list and a list of strings describing each
+    loop that was transformed
+    """
+    report = []
+    temps = []
+    out = tokens[:3]
+    optimize_block(tokens, 3, len(tokens) - 1, out, report, temps)
+    out.append(tokens[-1])
+    return out, report
+
+
+def optimize_block(tokens, start, stop, out, report, temps):
+    """
+    Append the optimized statements between start and stop to out
+    """
+    pos = start
+
+    for pos in analysis.statements(tokens, start, stop):
+        kind = tokens[pos].type
+        end = analysis.statement_end(tokens, pos)
+
+        if kind == "FOR":
+            header_end = analysis.find_close(tokens, pos + 1)
+            body = []
+            optimize_block(tokens, header_end, end - 1, body, report, temps)
+            optimize_for(tokens, pos, header_end, body, out, report, temps)
+
+        elif kind == "WHILE":
+            cond_end = analysis.condition_end(tokens, pos + 1)
+            body = []
+            optimize_block(tokens, cond_end + 1, end - 1, body, report, temps)
+            optimize_while(tokens, pos, cond_end, body, out, report, temps)
+
+        elif kind == "IF":
+            cond_end = analysis.condition_end(tokens, pos + 1)
+            else_pos = analysis.else_position(tokens, cond_end + 1, end - 1)
+            out.extend(tokens[pos : cond_end + 1])
+            optimize_block(tokens, cond_end + 1, else_pos, out, report, temps)
+            if else_pos < end - 1:
+                out.extend(tokens[else_pos : else_pos + 2])
+                optimize_block(tokens, else_pos + 2, end - 1, out, report, temps)
+            out.append(tokens[end - 1])
+
+        elif kind == "FUNCTION":
+            body_start = analysis.find_close(tokens, pos + 2) + 1
+            out.extend(tokens[pos:body_start])
+            optimize_block(tokens, body_start, end - 1, out, report, temps)
+            out.append(tokens[end - 1])
+
+        else:
+            out.extend(tokens[pos:end])
+
+        pos = end
+
+    # Keep anything the statement scan could not account for
+    out.extend(tokens[pos:stop])
+
+
+def optimize_for(tokens, pos, header_end, body, out, report, temps):
+    """
+    Append the for loop at pos, with its optimized body, to out
+
+    'for' '(' Name ':=' Expression 'to' Expression ')' Block 'end'
+    """
+    index_var = tokens[pos + 2].value
+    first_end = analysis.expression_end(tokens, pos + 4)
+    first = analysis.constant(tokens, pos + 4, first_end)
+    last = analysis.constant(tokens, first_end + 1, header_end - 1)
+
+    count = None
+    if first is not None and last is not None:
+        count = 0 if first > last else int(last - first) + 1
+
+    # Unroll: set the loop variable before each copy of the body, and
+    # leave it one past the last iteration as the loop would
+    if (
+        count is not None
+        and count <= UNROLL_LIMIT
+        and count * len(body) <= UNROLL_TOKENS
+        and index_var not in analysis.assigned_names(body, 0, len(body))
+    ):
+        for i in range(count + 1):
+            out.append(lexer.Token("NAME", index_var))
+            out.append(lexer.Token("ASSIGN", ":="))
+            out.append(lexer.Token("NUMBER", first + i))
+            if i < count:
+                out.extend(body)
+
+        report.append("for loop over %s at token %d: unrolled %d iterations" % (index_var, pos, count))
+        return
+
+    # Hoisting is only safe if the body runs at least once, which is
+    # known for constant bounds
+    hoisted = []
+    if count is not None and count > 0:
+        written = analysis.assigned_names(body, 0, len(body)) | {index_var}
+        body = hoist(body, written, hoisted, temps)
+
+    out.extend(hoisted)
+    out.extend(tokens[pos:header_end])
+    out.extend(body)
+    out.append(lexer.Token("END", "end"))
+
+    if hoisted:
+        report.append(
+            "for loop over %s at token %d: hoisted %d expressions"
+            % (index_var, pos, count_statements(hoisted))
+        )
+
+
+def optimize_while(tokens, pos, cond_end, body, out, report, temps):
+    """
+    Append the while loop at pos, with its optimized body, to out
+
+    'while' Condition ':' Block 'end'
+
+    Hoisted expressions are computed under an if statement with the
+    same condition, so they only run if the loop body would
+    """
+    condition = tokens[pos + 1 : cond_end]
+    written = analysis.assigned_names(body, 0, len(body))
+
+    hoisted = []
+    if not has_call(condition, 0, len(condition)):
+        body = hoist(body, written, hoisted, temps)
+
+    if hoisted:
+        out.append(lexer.Token("IF", "if"))
+        out.extend(condition)
+        out.append(lexer.Token("COLON", ":"))
+        out.extend(hoisted)
+
+    out.extend(tokens[pos : cond_end + 1])
+    out.extend(body)
+    out.append(lexer.Token("END", "end"))
+
+    if hoisted:
+        out.append(lexer.Token("END", "end"))
+        report.append(
+            "while loop at token %d: hoisted %d expressions" % (pos, count_statements(hoisted))
+        )
+
+
+def hoist(body, written, hoisted, temps):
+    """
+    Move loop-invariant expressions out of a loop body
+
+    Only the assignments at the start of the body are considered, so
+    nothing observable happens in the loop before a hoisted expression
+    would have been computed. Each invariant right-hand side, or
+    parenthesized part of one, is assigned to a new temporary appended
+    to hoisted, and replaced by that temporary in the body.
+
+    Return the new body.
+    """
+    out = []
+    pos = 0
+
+    # Temporaries already holding each hoisted expression, so repeated
+    # expressions are only computed once
+    seen = {}
+
+    for pos in analysis.statements(body, 0, len(body)):
+        end = analysis.statement_end(body, pos)
+        if body[pos].type != "NAME" or body[pos + 1].type != "ASSIGN" or has_call(body, pos, end):
+            break
+
+        out.extend(body[pos : pos + 2])
+
+        if invariant(body, pos + 2, end, written):
+            out.append(temporary(body, pos + 2, end, hoisted, temps, seen))
+        else:
+            i = pos + 2
+            while i < end:
+                if body[i].type == "LPAREN":
+                    close = analysis.find_close(body, i)
+                    if invariant(body, i + 1, close - 1, written):
+                        out.append(temporary(body, i + 1, close - 1, hoisted, temps, seen))
+                        i = close
+                        continue
+                out.append(body[i])
+                i += 1
+
+        pos = end
+    else:
+        pos = len(body)
+
+    out.extend(body[pos:])
+    return out
+
+
+def temporary(body, start, stop, hoisted, temps, seen):
+    """
+    Assign the expression between start and stop to a new temporary
+    and return a token naming it
+
+    Temporaries start with '$', which the lexer never produces, so
+    they cannot clash with the program's own variables
+    """
+    key = tuple((t.type, t.value) for t in body[start:stop])
+    if key in seen:
+        return lexer.Token("NAME", seen[key])
+
+    name = "$t%d" % len(temps)
+    temps.append(name)
+    seen[key] = name
+
+    hoisted.append(lexer.Token("NAME", name))
+    hoisted.append(lexer.Token("ASSIGN", ":="))
+    hoisted.extend(body[start:stop])
+    return lexer.Token("NAME", name)
+
+
+def invariant(tokens, start, stop, written):
+    """
+    Check if the expression between start and stop is worth hoisting and
+    gives the same value on every iteration of a loop assigning written
+    """
+    has_operator = False
+
+    for pos in range(start, stop):
+        t = tokens[pos]
+        if t.type not in HOISTABLE:
+            return False
+        if t.type == "NAME" and (t.value in written or has_call(tokens, pos, pos + 1)):
+            return False
+        if t.type in ("PLUS", "MULTIPLY") or (t.type == "MINUS" and pos > start):
+            has_operator = True
+
+    return has_operator
+
+
+def has_call(tokens, start, stop):
+    """
+    Check if there is a function call between start and stop
+    """
+    for pos in range(start, stop):
+        if tokens[pos].type == "NAME" and pos + 1 < len(tokens) and tokens[pos + 1].type == "LPAREN":
+            return True
+    return False
+
+
+def count_statements(hoisted):
+    """
+    Return the number of assignments in a list of hoisted tokens
+    """
+    return sum(1 for t in hoisted if t.type == "ASSIGN")
+
+
+### Main
+if __name__ == "__main__":
+    # The name of the program file is the first command line argument
+    filename = sys.argv[1]
+
+    source = open(filename).read()
+    tokens, report = optimize(lexer.analyze(source))
+
+    for line in report:
+        print(line)
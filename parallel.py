@@ -0,0 +1,175 @@
+"""
+Parallel execution of independent for loop iterations
+
+A for loop can be split across processes when no iteration depends on
+a value computed by an earlier one. Each worker runs a contiguous block
+of iterations on its own copy of the symbol table, and the results are
+merged back in iteration order so the program's output is unchanged.
+"""
+
+import analysis, contextlib, io, math, os, sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Only loops doing at least this much work (body tokens * iterations)
+# are worth the cost of sending them to other processes
+MIN_WORK = 200000
+
+# Number of iteration blocks handed to each worker process
+BLOCKS_PER_WORKER = 4
+
+# The pool is created on first use and shared by every parallel loop
+pool = None
+workers = os.cpu_count() or 1
+
+# Results of the dependence analysis for the program being run, keyed
+# by the position of the loop body
+analyzed = {}
+
+
+def reset():
+    """
+    Forget the loops of the last program, before a new one runs
+    """
+    analyzed.clear()
+
+
+def independent(tokens, start, stop, index_var):
+    """
+    Dependence analysis for the body of a for loop
+
+    Return True if the iterations of the body between start and stop
+    can run in any order. This holds when the body never reads a value
+    written by an earlier iteration, never assigns the loop variable and
+    does no input. Loops that modify arrays stay serial, since each
+    worker only has its own copy of them, and so do loops that call
+    functions or return from one.
+    """
+    written = analysis.assigned_names(tokens, start, stop)
+
+    if index_var in written:
+        return False
+
+    for pos in range(start, stop):
+        if tokens[pos].type in ("INPUT", "QUIT", "ARRAY", "FILL", "FUNCTION", "RETURN"):
+            return False
+
+        # Called functions may print or read input
+        if tokens[pos].type == "NAME" and tokens[pos + 1].type == "LPAREN":
+            return False
+
+    return analysis.assigned_before_read(tokens, start, stop, written, set())
+
+
+def run_block(body, symbols, index_var, first, last, fuse):
+    """
+    Worker process entry point
+
+    Run iterations first..last of the loop body and return the printed
+    output along with the variables the body assigned. fuse is True if
+    the body's fused shapes should be used (see fusion.py).
+    """
+    import fusion, interpreter
+
+    interpreter.tokens = body
+    interpreter.fused_statements, interpreter.fused_conditions = {}, {}
+    if fuse:
+        interpreter.fused_statements, interpreter.fused_conditions = fusion.fuse(body)
+    interpreter.symbols = interpreter.global_symbols = symbols
+    interpreter.parallel_loops = False
+
+    # Workers are forked with whatever run the parent had in progress
+    # when the pool was created, so everything that run set up is reset
+    interpreter.collecting = False
+    interpreter.jit_loops = False
+    interpreter.tracer = None
+    interpreter.max_operations = None
+    interpreter.counting = False
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        for i in range(first, last + 1):
+            symbols[index_var] = i
+            interpreter.next = 0
+            interpreter.block()
+
+    return output.getvalue(), symbols
+
+
+def abandon(futures, error):
+    """
+    Cancel the blocks of a loop that have not started, after error
+
+    A worker that died breaks the whole pool, so a new one is created
+    for the next loop.
+    """
+    global pool
+
+    for f in futures:
+        f.cancel()
+    if isinstance(error, BrokenProcessPool):
+        pool = None
+
+
+def run_loop(tokens, start, symbols, index_var, last, fuse=True):
+    """
+    Run the for loop whose body starts at start in parallel, if possible
+
+    symbols is updated in place with the values the loop assigned.
+    Return the value of the loop variable at which serial execution
+    should continue: last + 1 if every iteration ran, or the first
+    iteration of a block that failed so the interpreter can reproduce
+    the error itself. fuse is passed on to the workers.
+    """
+    import interpreter
+
+    global pool
+
+    first = symbols[index_var]
+    stop = analysis.find_end(tokens, start)
+
+    if type(first) is not int or workers < 2:
+        return first
+    if (stop - start) * (last - first + 1) < MIN_WORK:
+        return first
+
+    if start not in analyzed:
+        analyzed[start] = independent(tokens, start, stop, index_var)
+    if not analyzed[start]:
+        return first
+
+    if pool is None:
+        pool = ProcessPoolExecutor(workers)
+
+    # The body is sent on its own, with its closing 'end', so workers
+    # do not need the rest of the program
+    body = tokens[start : stop + 1]
+    written = analysis.assigned_names(tokens, start, stop)
+    shared = {name: value for name, value in symbols.items() if name not in written}
+
+    last = math.floor(last)
+    size = max(1, (last - first + 1) // (workers * BLOCKS_PER_WORKER))
+    blocks = [(i, min(i + size - 1, last)) for i in range(first, last + 1, size)]
+    futures = []
+    try:
+        for lo, hi in blocks:
+            futures.append(pool.submit(run_block, body, shared, index_var, lo, hi, fuse))
+    except (Exception, SystemExit) as e:
+        abandon(futures, e)
+        return first
+
+    for (lo, hi), future in zip(blocks, futures):
+        try:
+            output, result = future.result()
+        except (Exception, SystemExit) as e:
+            abandon(futures, e)
+            return lo
+
+        sys.stdout.write(output)
+        if interpreter.collecting:
+            interpreter.count_output(output)
+        for name in written:
+            if name in result:
+                symbols[name] = result[name]
+
+    return last + 1
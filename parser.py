@@ -2,7 +2,10 @@
 Parser for compiler
 """
 
-import lexer, sys
+import lexer, metrics, sys, time
+
+# Print each token as it is matched
+verbose = True
 
 
 def check(tokens, expected):
@@ -17,11 +20,13 @@ def match(tokens, expected):
     If not, print and error and quit
     """
 
-    print("Matching " + str(tokens[0]) + " with " + str(expected))
     if len(tokens) == 0:
         print("Unexpected end of input")
         quit()
 
+    if verbose:
+        print("Matching " + str(tokens[0]) + " with " + str(expected))
+
     if tokens[0].type != expected:
         print("Expected", expected, "got", tokens[0].type)
         quit()
@@ -40,16 +45,86 @@ def input_statement(tokens):
 
 def assign_statement(tokens):
     """
-    AssignStatement --> Name ':=' Expression
+    AssignStatement --> Name ['[' Expression ']'] ':=' Expression
     """
-    # Match the starting name and assign operator
+    # Match the starting name, an optional index and the assign operator
     match(tokens, "NAME")
+    if check(tokens, "LBRACKET"):
+        index(tokens)
     match(tokens, "ASSIGN")
 
     # Call the expression parsing function
     expression(tokens)
 
 
+def array_statement(tokens):
+    """
+    ArrayStatement --> 'array' Name '[' Expression ']'
+    """
+    match(tokens, "ARRAY")
+    match(tokens, "NAME")
+    index(tokens)
+
+
+def fill_statement(tokens):
+    """
+    FillStatement --> 'fill' Name ':=' Expression
+    """
+    match(tokens, "FILL")
+    match(tokens, "NAME")
+    match(tokens, "ASSIGN")
+    expression(tokens)
+
+
+def index(tokens):
+    """
+    Index --> '[' Expression ']'
+    """
+    match(tokens, "LBRACKET")
+    expression(tokens)
+    match(tokens, "RBRACKET")
+
+
+def function_statement(tokens):
+    """
+    FunctionStatement --> 'function' Name '(' [Name {',' Name}] ')' ':' Block 'end'
+    """
+    match(tokens, "FUNCTION")
+    match(tokens, "NAME")
+    match(tokens, "LPAREN")
+    if check(tokens, "NAME"):
+        match(tokens, "NAME")
+        while check(tokens, "COMMA"):
+            match(tokens, "COMMA")
+            match(tokens, "NAME")
+    match(tokens, "RPAREN")
+    match(tokens, "COLON")
+    block(tokens)
+    match(tokens, "END")
+
+
+def return_statement(tokens):
+    """
+    ReturnStatement --> 'return' Expression
+    """
+    match(tokens, "RETURN")
+    expression(tokens)
+
+
+def call(tokens):
+    """
+    Call --> Name '(' [Expression {',' Expression}] ')'
+    """
+    match(tokens, "NAME")
+    match(tokens, "LPAREN")
+    if not check(tokens, "RPAREN"):
+        expression(tokens)
+        while check(tokens, "COMMA"):
+            match(tokens, "COMMA")
+            expression(tokens)
+    match(tokens, "RPAREN")
+
+
 def print_statement(tokens):
     """
     PrintStatement --> 'print' ':=' Expression
@@ -93,7 +168,7 @@ def while_statement(tokens):
 
 def for_statement(tokens):
     """
-    ForStatement --> 'for' '(' Name ':=' Expression 'to' Expression ')' Statement
+    ForStatement --> 'for' '(' Name ':=' Expression 'to' Expression ')' Block 'end'
     """
     match(tokens, "FOR")
     match(tokens, "LPAREN")
@@ -103,7 +178,8 @@ def for_statement(tokens):
     match(tokens, "TO")
     expression(tokens)
     match(tokens, "RPAREN")
-    statement(tokens)
+    block(tokens)
+    match(tokens, "END")
 
 
 def RelOp(tokens):
@@ -139,9 +215,16 @@ def statement(tokens):
     | AssignStatement
     | IfStatement
     | WhileStatement
-    | ForStatement"""
+    | ForStatement
+    | ArrayStatement
+    | FillStatement
+    | FunctionStatement
+    | ReturnStatement
+    | Call"""
     if check(tokens, "INPUT"):
         input_statement(tokens)
+    elif check(tokens, "NAME") and len(tokens) > 1 and tokens[1].type == "LPAREN":
+        call(tokens)
     elif check(tokens, "NAME"):
         assign_statement(tokens)
     elif check(tokens, "PRINT"):
@@ -152,6 +235,14 @@ def statement(tokens):
         while_statement(tokens)
     elif check(tokens, "FOR"):
         for_statement(tokens)
+    elif check(tokens, "ARRAY"):
+        array_statement(tokens)
+    elif check(tokens, "FILL"):
+        fill_statement(tokens)
+    elif check(tokens, "FUNCTION"):
+        function_statement(tokens)
+    elif check(tokens, "RETURN"):
+        return_statement(tokens)
 
 
 def block(tokens):
@@ -176,6 +267,10 @@ def block(tokens):
             "WHILE",
             "FOR",
             "NAME",
+            "ARRAY",
+            "FILL",
+            "FUNCTION",
+            "RETURN",
         ]:
             statement(tokens)
         else:
@@ -184,7 +279,7 @@ def block(tokens):
 
 def program(tokens):
     """
-    Program --> 'program' Name ':' Block 'end'
+    Program --> 'program' Name ':' {ImportStatement} Block 'end'
     """
     # Match the program keyword
     match(tokens, "PROGRAM")
@@ -195,6 +290,10 @@ def program(tokens):
     # Colon
     match(tokens, "COLON")
 
+    # Imports come before any other statement
+    while check(tokens, "IMPORT"):
+        import_statement(tokens)
+
     # Call the block() function to process the statement block
     block(tokens)
 
@@ -202,6 +301,29 @@ def program(tokens):
     match(tokens, "END")
 
 
+def module(tokens):
+    """
+    Module --> 'module' Name ':' {ImportStatement} Block 'end'
+    """
+    match(tokens, "MODULE")
+    match(tokens, "NAME")
+    match(tokens, "COLON")
+
+    while check(tokens, "IMPORT"):
+        import_statement(tokens)
+
+    block(tokens)
+    match(tokens, "END")
+
+
+def import_statement(tokens):
+    """
+    ImportStatement --> 'import' Name
+    """
+    match(tokens, "IMPORT")
+    match(tokens, "NAME")
+
+
 def condition(tokens):
     """
     Condition --> Expression RelOp Expression
@@ -253,10 +375,23 @@ def expression(tokens):
 
 def atom(tokens):
     """
-    Atom --> Name | Number | '(' Expression ')'
+    Atom --> Name ['[' Expression ']']
+     | Call
+     | Number
+     | '(' Expression ')'
+     | ('length' | 'sum') '(' Name ')'
     """
-    if check(tokens, "NAME"):
+    if check(tokens, "NAME") and len(tokens) > 1 and tokens[1].type == "LPAREN":
+        call(tokens)
+    elif check(tokens, "NAME"):
+        match(tokens, "NAME")
+        if check(tokens, "LBRACKET"):
+            index(tokens)
+    elif check(tokens, "LENGTH") or check(tokens, "SUM"):
+        match(tokens, tokens[0].type)
+        match(tokens, "LPAREN")
         match(tokens, "NAME")
+        match(tokens, "RPAREN")
     elif check(tokens, "NUMBER"):
         match(tokens, "NUMBER")
     else:
@@ -269,9 +404,16 @@ def atom(tokens):
 def parse(tokens):
     """
     Top-level method to parse an input token sequence
+
+    Unit --> Program | Module
     """
-    # Call the method to parse a top-level program
-    program(tokens)
+    start = time.perf_counter()
+
+    # Call the method to parse a top-level program or module
+    if check(tokens, "MODULE"):
+        module(tokens)
+    else:
+        program(tokens)
 
     # If parsing succeeds, then the sequence of tokens should be
     # empty after expr returns
@@ -282,6 +424,9 @@ def parse(tokens):
         print("Unmatched token", tokens[0])
         quit()
 
+    if metrics.enabled:
+        metrics.phase("parse", start)
+
 
 ### Main
 if __name__ == "__main__":
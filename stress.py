@@ -0,0 +1,404 @@
+"""
+Differential stress testing for compiler
+
+Generates random programs that follow the grammar in parser.py, checks
+that each one parses, then runs it through every execution engine of
+the interpreter and checks that they all print the same thing. A copy
+with a malformed statement added must fail the same way with and
+without fused statements. The time each engine takes is recorded so
+speedups can be compared.
+
+Generated programs always terminate: for loops have small constant
+bounds, every while loop counts a dedicated variable up to a small
+limit, loop variables are never assigned in their loop, and functions
+never call themselves.
+
+Usage: stress.py [count] [seed] [statements] [depth]
+"""
+
+import contextlib, io, random, sys, time
+import interpreter, jit, lexer, parallel, parser, tracing
+
+# Variables every program starts by assigning
+VARIABLES = ["a", "b", "c", "d"]
+
+RELOPS = ["=", "<>", "<", ">", "<=", ">="]
+
+
+class Generator:
+    """
+    Class that generates one random program
+
+    statements is the most statements in a block and depth the deepest
+    nesting of if, while and for statements
+    """
+
+    def __init__(self, rng, statements=6, depth=3):
+        self.rng = rng
+        self.statements = statements
+        self.depth = depth
+        self.lines = []
+        self.counters = 0
+        self.functions = []
+
+    def emit(self, indent, text):
+        self.lines.append("  " * indent + text)
+
+    def program(self):
+        """
+        Program --> 'program' Name ':' Block 'end'
+        """
+        self.emit(0, "program stress:")
+
+        for name in VARIABLES:
+            self.emit(1, "%s := %d" % (name, self.rng.randint(-5, 9)))
+        self.emit(1, "array arr[8]")
+
+        for i in range(self.rng.randint(0, 2)):
+            self.function(i)
+
+        self.block(1, set(VARIABLES), self.depth, in_function=False)
+        for name in VARIABLES:
+            self.emit(1, "print " + name)
+        self.emit(1, "print sum(arr)")
+        self.emit(0, "end")
+        return "\n".join(self.lines) + "\n"
+
+    def function(self, i):
+        """
+        FunctionStatement --> 'function' Name '(' [Name {',' Name}] ')' ':' Block 'end'
+
+        Functions read their parameters and the global variables, and
+        may call any function defined before them
+        """
+        name = "f%d" % i
+        params = ["p%d" % j for j in range(self.rng.randint(0, 2))]
+        self.emit(1, "function %s(%s):" % (name, ", ".join(params)))
+
+        readable = set(params) | set(VARIABLES)
+        self.block(2, readable, 2, in_function=True)
+        self.emit(2, "return " + self.expression(readable, 2))
+        self.emit(1, "end")
+
+        self.functions.append((name, len(params)))
+
+    def block(self, indent, readable, depth, in_function):
+        """
+        Block --> {Statement}
+
+        readable holds the variables defined at this point. Statements
+        only ever assign the variables in VARIABLES, or locals in a
+        function, so loop variables are never changed by their loop.
+        """
+        readable = set(readable)
+        for i in range(self.rng.randint(1, self.statements)):
+            self.statement(indent, readable, depth, in_function)
+
+    def statement(self, indent, readable, depth, in_function):
+        """
+        Statement --> AssignStatement | PrintStatement | IfStatement
+         | WhileStatement | ForStatement | FillStatement
+        """
+        choices = ["assign", "assign", "accumulate", "print", "element"]
+        if not in_function:
+            choices.append("fill")
+        if depth > 0:
+            choices += ["if", "while", "for"]
+        kind = self.rng.choice(choices)
+
+        if kind == "assign":
+            if in_function:
+                target = "t%d" % self.rng.randint(0, 2)
+            else:
+                target = self.rng.choice(VARIABLES)
+            self.emit(indent, "%s := %s" % (target, self.expression(readable, 2)))
+            readable.add(target)
+
+        elif kind == "accumulate":
+            target = self.rng.choice(VARIABLES)
+            operator = self.rng.choice("+-")
+            self.emit(indent, "%s := %s %s %s" % (target, target, operator, self.expression(readable, 2)))
+
+        elif kind == "print":
+            expr = self.expression(readable, 2)
+            if self.rng.random() < 0.2:
+                expr = "(%s) / %d" % (expr, self.rng.randint(1, 9))
+            self.emit(indent, "print " + expr)
+
+        elif kind == "element":
+            index = self.rng.randint(0, 7)
+            self.emit(indent, "arr[%d] := %s" % (index, self.expression(readable, 2)))
+
+        elif kind == "fill":
+            self.emit(indent, "fill arr := %s" % self.expression(readable, 1))
+
+        elif kind == "if":
+            self.emit(indent, "if %s:" % self.condition(readable))
+            self.block(indent + 1, readable, depth - 1, in_function)
+            if self.rng.random() < 0.5:
+                self.emit(indent, "else:")
+                self.block(indent + 1, readable, depth - 1, in_function)
+            self.emit(indent, "end")
+
+        elif kind == "while":
+            counter = "w%d" % self.counters
+            self.counters += 1
+            self.emit(indent, "%s := 0" % counter)
+            self.emit(indent, "while %s < %d:" % (counter, self.rng.randint(0, 5)))
+            self.block(indent + 1, readable | {counter}, depth - 1, in_function)
+            self.emit(indent + 1, "%s := %s + 1" % (counter, counter))
+            self.emit(indent, "end")
+            readable.add(counter)
+
+        elif kind == "for":
+            index = "i%d" % self.counters
+            self.counters += 1
+            first = self.rng.randint(-2, 3)
+            last = first + self.rng.randint(-1, 5)
+            self.emit(indent, "for (%s := %d to %d)" % (index, first, last))
+            self.block(indent + 1, readable | {index}, depth - 1, in_function)
+            self.emit(indent, "end")
+            readable.add(index)
+
+    def condition(self, readable):
+        """
+        Condition --> Expression RelOp Expression
+        """
+        return "%s %s %s" % (
+            self.expression(readable, 1),
+            self.rng.choice(RELOPS),
+            self.expression(readable, 1),
+        )
+
+    def expression(self, readable, depth):
+        """
+        Expression --> Term [('+' | '-') Expression]
+        """
+        text = self.term(readable, depth)
+        if depth > 0 and self.rng.random() < 0.5:
+            text += " %s %s" % (self.rng.choice("+-"), self.expression(readable, depth - 1))
+        return text
+
+    def term(self, readable, depth):
+        """
+        Term --> Factor [( '*' | '/' ) Factor]
+
+        One side of a product is always a small number, so values grow
+        slowly enough for every engine to handle
+        """
+        text = self.factor(readable, depth)
+        if self.rng.random() < 0.3:
+            text += " * %d" % self.rng.randint(0, 3)
+        return text
+
+    def factor(self, readable, depth):
+        """
+        Factor --> '-' Factor | Atom
+        """
+        if self.rng.random() < 0.1:
+            return "-" + self.atom(readable, depth)
+        return self.atom(readable, depth)
+
+    def atom(self, readable, depth):
+        """
+        Atom --> Name | Number | '(' Expression ')' | Call | Name '[' Expression ']'
+         | 'length' '(' Name ')' | 'sum' '(' Name ')'
+        """
+        roll = self.rng.random()
+
+        if roll < 0.35:
+            return self.rng.choice(sorted(readable))
+        elif roll < 0.6 or depth == 0:
+            return str(self.rng.randint(0, 9))
+        elif roll < 0.75:
+            return "(%s)" % self.expression(readable, depth - 1)
+        elif roll < 0.85 and self.functions:
+            name, params = self.rng.choice(self.functions)
+            args = [self.expression(readable, depth - 1) for i in range(params)]
+            return "%s(%s)" % (name, ", ".join(args))
+        elif roll < 0.95:
+            return "arr[%d]" % self.rng.randint(0, 7)
+        return self.rng.choice(["length(arr)", "sum(arr)"])
+
+
+def generate(seed, statements=6, depth=3):
+    """
+    Return the source of the random program for seed
+    """
+    return Generator(random.Random(seed), statements, depth).program()
+
+
+def malformed(seed, source):
+    """
+    Return source with an accumulate statement the grammar rejects
+    inserted before its final prints
+
+    A term allows only one '*' or '/', so the statement must fail at
+    its second one, fused or not.
+    """
+    rng = random.Random(seed)
+    target, operand = rng.sample(VARIABLES, 2)
+    statement = "  %s := %s %s %s %s %d %s %d" % (
+        target,
+        target,
+        rng.choice("+-"),
+        operand,
+        rng.choice("*/"),
+        rng.randint(1, 3),
+        rng.choice("*/"),
+        rng.randint(1, 3),
+    )
+
+    lines = source.splitlines()
+    lines.insert(len(lines) - len(VARIABLES) - 2, statement)
+    return "\n".join(lines) + "\n"
+
+
+def run_engine(source, options, setup=None):
+    """
+    Run source with the given interpreter options
+
+    Return what it printed, ending with the error if it failed, and the
+    time it took
+    """
+    output = io.StringIO()
+    start = time.perf_counter()
+
+    try:
+        with contextlib.redirect_stdout(output):
+            if setup is not None:
+                setup(source)
+            else:
+                interpreter.interpret(source, **options)
+    except SystemExit:
+        output.write("<quit>\n")
+    except Exception as e:
+        output.write("<%s>\n" % type(e).__name__)
+
+    return output.getvalue(), time.perf_counter() - start
+
+
+def replayed(source):
+    """
+    Record a trace of source, then replay it printing the output
+
+    The recorded run's own output is discarded, and so is its error if
+    it failed, since the replay must fail the same way. A run that quit
+    is replayed up to its quit event, then quits the same way.
+    """
+    recorder = tracing.Recorder(source)
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            interpreter.interpret(source, trace=recorder)
+        except SystemExit:
+            recorder.quit()
+        except Exception:
+            pass
+
+    tracing.replay(source, recorder.data, quiet=False)
+    if recorder.quitted:
+        quit()
+
+
+# Execution engines, each a name, interpreter options and an optional
+# function that runs the program itself
+ENGINES = [
+    ("serial", {"fuse": False}, None),
+    ("fused", {}, None),
+    ("parallel", {}, None),
+    ("optimized", {"optimize": True}, None),
+    ("jit", {"jit": True}, None),
+    ("optimized+jit", {"optimize": True, "jit": True}, None),
+    ("limited", {"limit": 10**9}, None),
+    ("replayed", {}, replayed),
+]
+
+
+def check(seed, statements, depth, timings):
+    """
+    Generate, parse and run one program through every engine
+
+    Return None if every engine agreed, otherwise a report of the
+    differences
+    """
+    source = generate(seed, statements, depth)
+
+    parser.verbose = False
+    try:
+        parser.parse(lexer.analyze(source))
+    except SystemExit:
+        return "seed %d: generated program does not parse\n%s" % (seed, source)
+    finally:
+        parser.verbose = True
+
+    results = {}
+    for name, options, setup in ENGINES:
+        interpreter.parallel_loops = name == "parallel"
+        results[name], elapsed = run_engine(source, options, setup)
+        timings[name] = timings.get(name, 0) + elapsed
+    interpreter.parallel_loops = True
+
+    expected = results["serial"]
+    different = [name for name in results if results[name] != expected]
+
+    # Fused statements must reject what the generic path rejects
+    if not different:
+        source = malformed(seed, source)
+        expected = run_engine(source, {"fuse": False})[0]
+        if run_engine(source, {})[0] != expected:
+            return "seed %d: fused differs from serial on a malformed program\n%s" % (seed, source)
+        return None
+
+    report = ["seed %d: %s differ from serial" % (seed, ", ".join(different)), source]
+    report.append("serial:\n" + expected)
+    for name in different:
+        report.append(name + ":\n" + results[name])
+    return "\n".join(report)
+
+
+def stress(count, seed=0, statements=6, depth=3):
+    """
+    Check count programs starting from seed
+
+    Return the list of failure reports and the total time per engine
+    """
+    # Make the adaptive engines kick in on the small generated loops,
+    # for these checks only
+    saved = jit.HOT_THRESHOLD, parallel.MIN_WORK, parallel.workers
+    jit.HOT_THRESHOLD = 2
+    parallel.MIN_WORK = 0
+    parallel.workers = max(parallel.workers, 2)
+
+    failures = []
+    timings = {}
+    try:
+        for i in range(seed, seed + count):
+            failure = check(i, statements, depth, timings)
+            if failure is not None:
+                failures.append(failure)
+    finally:
+        jit.HOT_THRESHOLD, parallel.MIN_WORK, parallel.workers = saved
+
+    return failures, timings
+
+
+### Main
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    count = args[0] if len(args) > 0 else 100
+    seed = args[1] if len(args) > 1 else 0
+    statements = args[2] if len(args) > 2 else 6
+    depth = args[3] if len(args) > 3 else 3
+
+    failures, timings = stress(count, seed, statements, depth)
+
+    for failure in failures:
+        print(failure)
+        print()
+
+    for name, options, setup in ENGINES:
+        print("%-14s %8.3fs" % (name, timings[name]))
+    print("%d programs, %d failures" % (count, len(failures)))
+
+    if failures:
+        sys.exit(1)
@@ -0,0 +1,429 @@
+"""
+Execution traces for compiler
+
+A trace records everything that makes a run of a program
+nondeterministic or observable: the values read by input statements,
+the outcome of every if and while condition, everything printed, and
+whether the program stopped early with quit, an operation limit or a
+runtime error. Replaying a trace reruns the program without prompting for input and
+checks that it takes the same path and prints the same output.
+
+Trace format, all integers as varints:
+
+    'PTRC' version digest[8] elapsed_ns count {event}
+
+    event --> INPUT zigzag(value)
+            | FALSE | TRUE
+            | OUTPUT length utf8-text
+            | QUIT
+
+elapsed_ns only counts the time spent running, not the time spent
+waiting for input to be typed.
+"""
+
+import contextlib, hashlib, io, sys, time
+import interpreter
+
+MAGIC = b"PTRC"
+VERSION = 2
+
+# Event kinds
+INPUT = 1
+FALSE = 2
+TRUE = 3
+OUTPUT = 4
+QUIT = 5
+
+NAMES = {INPUT: "input", FALSE: "branch", TRUE: "branch", OUTPUT: "output", QUIT: "quit"}
+
+
+class TraceMismatch(Exception):
+    """
+    Raised when a replayed run does something the trace did not record,
+    or when a trace cannot be decoded
+    """
+
+
+class FastForward(Exception):
+    """
+    Raised to stop a replay once it reaches the requested step
+    """
+
+
+def write_varint(out, n):
+    """
+    Append the unsigned integer n to the bytearray out
+    """
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def read_varint(data, pos):
+    """
+    Read an unsigned integer from data at pos, return it and the new position
+    """
+    n = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def digest(source):
+    """
+    Short fingerprint of the program a trace was recorded from
+    """
+    return hashlib.sha256(source.encode()).digest()[:8]
+
+
+class Recorder:
+    """
+    Tracer that records a run
+
+    The interpreter calls input, branch and output as it runs, and
+    finish when the program is done. self.data then holds the trace.
+    If the program stopped early, quit is called after finish to add a
+    quit event to the trace.
+
+    Events are encoded into self.events as they happen, and counted in
+    self.count. self.waiting is the time spent waiting for input.
+    """
+
+    def __init__(self, source):
+        self.digest = digest(source)
+        self.events = bytearray()
+        self.count = 0
+        self.start = time.perf_counter_ns()
+        self.waiting = 0
+        self.elapsed = None
+        self.quitted = False
+        self.data = None
+
+    def event(self, kind, value=None):
+        write_event(self.events, kind, value)
+        self.count += 1
+
+    def input(self, name):
+        paused = time.perf_counter_ns()
+        print("Enter a value for", name)
+        value = int(input())
+        self.waiting += time.perf_counter_ns() - paused
+
+        self.event(INPUT, value)
+        return value
+
+    def branch(self, value):
+        self.event(TRUE if value else FALSE)
+
+    def output(self, value):
+        self.event(OUTPUT, str(value))
+
+    def finish(self):
+        self.elapsed = time.perf_counter_ns() - self.start - self.waiting
+        self.data = dump(self.digest, self.elapsed, self.count, self.events)
+
+    def quit(self):
+        # A run that failed before it started, e.g. in the lexer, never
+        # finished
+        if self.elapsed is None:
+            self.elapsed = time.perf_counter_ns() - self.start - self.waiting
+
+        self.quitted = True
+        self.event(QUIT)
+        self.data = dump(self.digest, self.elapsed, self.count, self.events)
+
+
+class Replayer:
+    """
+    Tracer that replays a recorded run
+
+    Input values come from the trace, and every branch and output is
+    checked against it. If stop is given, the run is stopped after
+    that many events.
+    """
+
+    def __init__(self, source, data, stop=None):
+        trace_digest, self.recorded, self.count, pos = header(data)
+        if trace_digest != digest(source):
+            raise TraceMismatch("trace was recorded from a different program")
+
+        # Events are decoded one at a time as the replay reaches them
+        self.events = read_events(data, pos, self.count)
+
+        self.step = 0
+        self.stop = stop
+        self.start = time.perf_counter_ns()
+        self.elapsed = None
+
+    def next_event(self, kind, value):
+        if self.stop is not None and self.step >= self.stop:
+            raise FastForward()
+
+        if self.step >= self.count:
+            raise TraceMismatch("step %d: run continued past the end of the trace" % self.step)
+
+        expected = next(self.events)
+        if NAMES[expected[0]] != NAMES[kind]:
+            raise TraceMismatch(
+                "step %d: expected %s, got %s" % (self.step, NAMES[expected[0]], NAMES[kind])
+            )
+        if kind != INPUT and expected != (kind, value):
+            raise TraceMismatch(
+                "step %d: expected %s %s, got %s"
+                % (self.step, NAMES[kind], describe(expected), describe((kind, value)))
+            )
+
+        self.step += 1
+        return expected[1]
+
+    def input(self, name):
+        return self.next_event(INPUT, None)
+
+    def branch(self, value):
+        self.next_event(TRUE if value else FALSE, None)
+
+    def output(self, value):
+        self.next_event(OUTPUT, str(value))
+
+    def finish(self):
+        self.elapsed = time.perf_counter_ns() - self.start
+
+    def quit(self):
+        self.next_event(QUIT, None)
+
+
+def describe(event):
+    """
+    Return a short description of an event's value
+    """
+    kind, value = event
+    if kind == TRUE:
+        return "true"
+    elif kind == FALSE:
+        return "false"
+    elif kind == QUIT:
+        return ""
+    return repr(value)
+
+
+def write_event(out, kind, value):
+    """
+    Append one encoded event to the bytearray out
+    """
+    out.append(kind)
+    if kind == INPUT:
+        # zigzag encoding keeps small negative numbers small
+        write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+    elif kind == OUTPUT:
+        text = value.encode()
+        write_varint(out, len(text))
+        out += text
+
+
+def dump(trace_digest, elapsed, count, events):
+    """
+    Encode a trace as bytes, given count events already encoded
+    """
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    out += trace_digest
+    write_varint(out, elapsed)
+    write_varint(out, count)
+    out += events
+    return bytes(out)
+
+
+def header(data):
+    """
+    Decode the start of a trace, return its program digest, elapsed
+    time, event count and the position of the first event
+    """
+    if data[:4] != MAGIC or len(data) < 13 or data[4] != VERSION:
+        raise TraceMismatch("not a version %d trace" % VERSION)
+
+    trace_digest = data[5:13]
+    try:
+        elapsed, pos = read_varint(data, 13)
+        count, pos = read_varint(data, pos)
+    except IndexError:
+        raise TraceMismatch("trace header is truncated") from None
+    return trace_digest, elapsed, count, pos
+
+
+def read_events(data, pos, count):
+    """
+    Decode count events starting at pos, yielding each as (kind, value)
+
+    Raises TraceMismatch when the data ends early or an event cannot be
+    decoded
+    """
+    for i in range(count):
+        try:
+            kind = data[pos]
+            pos += 1
+            value = None
+            if kind == INPUT:
+                n, pos = read_varint(data, pos)
+                value = n // 2 if n % 2 == 0 else -(n + 1) // 2
+            elif kind == OUTPUT:
+                length, pos = read_varint(data, pos)
+                if pos + length > len(data):
+                    raise IndexError()
+                value = data[pos : pos + length].decode()
+                pos += length
+        except IndexError:
+            raise TraceMismatch("step %d: trace is truncated" % i) from None
+        except UnicodeDecodeError:
+            raise TraceMismatch("step %d: output is not valid text" % i) from None
+
+        if kind not in NAMES:
+            raise TraceMismatch("step %d: unknown event %d" % (i, kind))
+        yield kind, value
+
+
+def load(data):
+    """
+    Decode a trace, return its program digest, elapsed time and events
+    """
+    trace_digest, elapsed, count, pos = header(data)
+    return trace_digest, elapsed, list(read_events(data, pos, count))
+
+
+def record(source):
+    """
+    Run a program and return its trace
+
+    A program that stops early still has its trace returned, ending in
+    a quit event
+    """
+    recorder = Recorder(source)
+    try:
+        interpreter.interpret(source, trace=recorder)
+    except SystemExit:
+        recorder.quit()
+    return recorder.data
+
+
+def replay(source, data, stop=None, quiet=True):
+    """
+    Replay a trace of source
+
+    Return the symbol table at the end of the run, or after stop events
+    if stop is given. Raises TraceMismatch if the run does not follow
+    the trace. Output is only printed if quiet is False.
+    """
+    replayer = Replayer(source, data, stop)
+    output = io.StringIO() if quiet else sys.stdout
+
+    try:
+        with contextlib.redirect_stdout(output):
+            try:
+                interpreter.interpret(source, trace=replayer)
+            except SystemExit:
+                replayer.quit()
+    except FastForward:
+        return interpreter.symbols
+
+    if replayer.step != replayer.count:
+        raise TraceMismatch("run ended at step %d of %d" % (replayer.step, replayer.count))
+    return interpreter.symbols
+
+
+def diff(a, b):
+    """
+    Compare two traces and return a list of report lines
+
+    Reports the first step where the runs differ, and the change in
+    running time and in the number of each kind of event
+    """
+    digest_a, elapsed_a, events_a = load(a)
+    digest_b, elapsed_b, events_b = load(b)
+    report = []
+
+    if digest_a != digest_b:
+        report.append("traces are from different programs")
+
+    for step in range(min(len(events_a), len(events_b))):
+        if events_a[step] != events_b[step]:
+            report.append(
+                "first difference at step %d: %s %s vs %s %s"
+                % (
+                    step,
+                    NAMES[events_a[step][0]],
+                    describe(events_a[step]),
+                    NAMES[events_b[step][0]],
+                    describe(events_b[step]),
+                )
+            )
+            break
+    else:
+        if len(events_a) != len(events_b):
+            report.append("one trace ends at step %d" % min(len(events_a), len(events_b)))
+
+    report.append(change("time (ms)", elapsed_a / 1e6, elapsed_b / 1e6))
+    report.append(change("events", len(events_a), len(events_b)))
+    kinds = [
+        (INPUT, "inputs"),
+        (TRUE, "branches taken"),
+        (FALSE, "branches not taken"),
+        (OUTPUT, "outputs"),
+        (QUIT, "quits"),
+    ]
+    for kind, label in kinds:
+        count_a = sum(1 for e in events_a if e[0] == kind)
+        count_b = sum(1 for e in events_b if e[0] == kind)
+        report.append(change(label, count_a, count_b))
+
+    return report
+
+
+def change(label, old, new):
+    """
+    Format a before/after comparison as a report line
+    """
+    if old:
+        return "%s: %g -> %g (%+.1f%%)" % (label, old, new, (new - old) * 100 / old)
+    return "%s: %g -> %g" % (label, old, new)
+
+
+### Main
+#
+# tracing.py record program.p out.trace
+# tracing.py replay program.p in.trace [step]
+# tracing.py diff old.trace new.trace
+if __name__ == "__main__":
+    command = sys.argv[1]
+
+    if command == "record":
+        data = record(open(sys.argv[2]).read())
+        open(sys.argv[3], "wb").write(data)
+
+    elif command == "replay":
+        source = open(sys.argv[2]).read()
+        data = open(sys.argv[3], "rb").read()
+        stop = int(sys.argv[4]) if len(sys.argv) > 4 else None
+        try:
+            symbols = replay(source, data, stop, quiet=stop is not None)
+        except TraceMismatch as e:
+            print("Replay diverged:", e)
+            quit()
+        if stop is not None:
+            for name, value in symbols.items():
+                print(name, "=", value)
+
+    elif command == "diff":
+        a = open(sys.argv[2], "rb").read()
+        b = open(sys.argv[3], "rb").read()
+        try:
+            lines = diff(a, b)
+        except TraceMismatch as e:
+            print("Cannot compare traces:", e)
+            quit()
+        for line in lines:
+            print(line)